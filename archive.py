@@ -0,0 +1,308 @@
+"""
+Archives that pack many replays into one file, for jumping to any
+tick of any round without playing it from the start.
+
+Next to each replay the archive keeps the final trails of every
+player and a keyframe every keyframe_interval ticks. Trails only
+ever grow, so a keyframe just says how many lines each player had
+and where the current one ended. An index at the end of the file
+points at every round, and the reader goes through mmap, so finding
+a round or a keyframe never reads more than it needs.
+
+    python archive.py pack rounds.cya replays/*.cyr
+    python archive.py info rounds.cya
+
+    reader = archive.ArchiveReader("rounds.cya")
+    simulation = reader.seek(12, 3000)
+"""
+
+import os
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+import argparse
+import array
+import mmap
+import struct
+import sys
+
+import cycles
+import replay
+
+
+MAGIC = b"CYRA"
+VERSION = 1
+
+# magic, version, keyframe interval
+FILE_HEADER = struct.Struct("<4sBI")
+# index offset, round count, magic
+FOOTER = struct.Struct("<QI4s")
+# replay offset, replay length, player count, trails offset,
+# keyframes offset, keyframe count, ticks
+INDEX_ENTRY = struct.Struct("<QIBQQII")
+# tick, shrink counter, map x, y, w, h
+KEYFRAME = struct.Struct("<IIiiii")
+# x, y, direction, alive, line count, end of current line x, y
+KEYFRAME_PLAYER = struct.Struct("<iiBBIii")
+
+
+class Keyframe():
+    def __init__(self):
+        self.tick = 0
+        self.shrink_counter = 0
+        self.map_rect = (0, 0, 0, 0)
+
+        # (x, y, direction, alive, line count, end x, end y) per player
+        self.players = []
+
+
+def make_keyframe(simulation):
+    k = Keyframe()
+    k.tick = simulation.ticks
+    k.shrink_counter = simulation.shrink_counter
+
+    game_map = simulation.game_map
+    k.map_rect = (game_map.x, game_map.y, game_map.width, game_map.height)
+
+    for p in simulation.players:
+        end_x = 0
+        end_y = 0
+        if len(p.trail) > 0:
+            end_x = p.trail.x2[-1]
+            end_y = p.trail.y2[-1]
+        alive = not p in simulation.crashed_players
+        k.players.append((p.x, p.y, p.direction, alive, len(p.trail), end_x, end_y))
+
+    return k
+
+
+def restore(r, keyframe, trails):
+    """
+    r -> the Replay of the round
+    trails -> per player, the round's final lines as x1, y1, x2, y2
+    """
+    # set up a Simulation at the keyframe, it can be stepped from there
+    # like one from Replay.play. how long the players that crashed
+    # before the keyframe lasted is not known.
+    players = [replay.ReplayPlayer(cycles.pygame.Color(*color)) for x, y, d, color in r.players]
+    for tick, player, direction in r.turns:
+        players[player].turns[tick] = direction
+
+    game_map = cycles.GameMap(*r.map_rect, r.seed)
+    for rect in r.obstacles:
+        game_map.add_obstacle(*rect)
+    game_map.set_rect(*keyframe.map_rect)
+
+    crashed_players = []
+    for p, state, trail in zip(players, keyframe.players, trails):
+        x, y, direction, alive, line_count, end_x, end_y = state
+        p.x = x
+        p.y = y
+        p.direction = direction
+
+        p.trail.clear()
+        for i in range(line_count):
+            p.trail.add(*trail[i*4:i*4+4])
+        if line_count > 0:
+            p.trail.set_end(end_x, end_y)
+
+        game_map.add_player(p)
+        if not alive:
+            p.crashed = True
+            crashed_players.append(p)
+
+    game_map.enable_occupancy()
+    # the trails came in after the map had shrunk
+    game_map.prune()
+
+    simulation = cycles.Simulation(players, r.tick_rate, r.shrink_seconds, r.shrink_size)
+    simulation.start_round(game_map=game_map)
+    simulation.ticks = keyframe.tick
+    simulation.shrink_counter = keyframe.shrink_counter
+    simulation.crashed_players = crashed_players
+    for p in players:
+        p.simulation = simulation
+
+    return simulation
+
+
+class ArchiveWriter():
+    def __init__(self, path, keyframe_interval=600):
+        self.file = open(path, "wb")
+        self.keyframe_interval = keyframe_interval
+
+        # one INDEX_ENTRY tuple per round
+        self.index = []
+
+        self.file.write(FILE_HEADER.pack(MAGIC, VERSION, keyframe_interval))
+
+    def add(self, r):
+        # plays the replay once to make the keyframes
+        simulation = r.play(until_tick=0)
+        keyframes = [make_keyframe(simulation)]
+        while not simulation.round_over:
+            simulation.step()
+            if simulation.ticks % self.keyframe_interval == 0 and not simulation.round_over:
+                keyframes.append(make_keyframe(simulation))
+
+        replay_data = r.to_bytes()
+        replay_offset = self.file.tell()
+        self.file.write(replay_data)
+
+        # each player's lines, oldest first, after a count for each
+        trails_offset = self.file.tell()
+        counts = array.array("I", [len(p.trail) for p in simulation.players])
+        self.file.write(struct.pack("<{}I".format(len(counts)), *counts))
+        for p in simulation.players:
+            t = p.trail
+            trail = array.array("i")
+            for i in range(len(t)):
+                trail.extend(t.get_row(i))
+            self.file.write(struct.pack("<{}i".format(len(trail)), *trail))
+
+        keyframes_offset = self.file.tell()
+        for k in keyframes:
+            self.file.write(KEYFRAME.pack(k.tick, k.shrink_counter, *k.map_rect))
+            for x, y, direction, alive, line_count, end_x, end_y in k.players:
+                self.file.write(KEYFRAME_PLAYER.pack(x, y, replay.DIRECTIONS.index(direction),
+                                                     alive, line_count, end_x, end_y))
+
+        self.index.append((replay_offset, len(replay_data), len(r.players),
+                           trails_offset, keyframes_offset, len(keyframes), r.ticks))
+
+    def close(self):
+        index_offset = self.file.tell()
+        for entry in self.index:
+            self.file.write(INDEX_ENTRY.pack(*entry))
+        self.file.write(FOOTER.pack(index_offset, len(self.index), MAGIC))
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ArchiveReader():
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.keyframe_interval = FILE_HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC:
+            raise Exception("not a cycles archive")
+        if version != VERSION:
+            raise Exception("unsupported archive version: {}".format(version))
+
+        self.index_offset, self.round_count, magic = FOOTER.unpack_from(self.data, len(self.data) - FOOTER.size)
+        if magic != MAGIC:
+            raise Exception("archive was not closed properly")
+
+    def __len__(self):
+        return self.round_count
+
+    def get_entry(self, i):
+        # (replay offset, replay length, player count, trails offset,
+        # keyframes offset, keyframe count, ticks)
+        if i < 0 or i >= self.round_count:
+            raise IndexError("no round {} in archive".format(i))
+        return INDEX_ENTRY.unpack_from(self.data, self.index_offset + i * INDEX_ENTRY.size)
+
+    def get_replay(self, i):
+        offset, length = self.get_entry(i)[:2]
+        return replay.from_bytes(self.data[offset:offset+length])
+
+    def get_trails(self, i):
+        # per player, a read-only view of the final lines as
+        # x1, y1, x2, y2 ints, straight out of the file.
+        entry = self.get_entry(i)
+        player_count = entry[2]
+        offset = entry[3]
+        counts = struct.unpack_from("<{}I".format(player_count), self.data, offset)
+
+        view = memoryview(self.data)
+        offset += player_count * 4
+        trails = []
+        for count in counts:
+            trails.append(view[offset:offset + count*16].cast("i"))
+            offset += count * 16
+
+        return trails
+
+    def get_keyframe(self, i, tick):
+        # the last keyframe at or before tick
+        entry = self.get_entry(i)
+        player_count = entry[2]
+        n = min(tick // self.keyframe_interval, entry[5] - 1)
+
+        size = KEYFRAME.size + player_count * KEYFRAME_PLAYER.size
+        offset = entry[4] + n * size
+
+        k = Keyframe()
+        k.tick, k.shrink_counter, *map_rect = KEYFRAME.unpack_from(self.data, offset)
+        k.map_rect = tuple(map_rect)
+        offset += KEYFRAME.size
+        for j in range(player_count):
+            x, y, direction, alive, line_count, end_x, end_y = KEYFRAME_PLAYER.unpack_from(self.data, offset)
+            k.players.append((x, y, replay.DIRECTIONS[direction], bool(alive), line_count, end_x, end_y))
+            offset += KEYFRAME_PLAYER.size
+
+        return k
+
+    def seek(self, i, tick):
+        # a Simulation of round i at tick (or where the round
+        # ended, if that is earlier).
+        r = self.get_replay(i)
+        simulation = restore(r, self.get_keyframe(i, tick), self.get_trails(i))
+        while simulation.ticks < tick and not simulation.round_over:
+            simulation.step()
+
+        return simulation
+
+    def rounds(self):
+        # go through all the replays in order
+        for i in range(self.round_count):
+            yield self.get_replay(i)
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pack replays into archives and look inside them.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    pack = commands.add_parser("pack", help="pack replay files into an archive")
+    pack.add_argument("archive")
+    pack.add_argument("replays", nargs="+")
+    pack.add_argument("--keyframe-interval", type=int, default=600,
+                      help="ticks between keyframes")
+
+    info = commands.add_parser("info", help="list the rounds in an archive")
+    info.add_argument("archive")
+
+    args = parser.parse_args()
+
+    if args.command == "pack":
+        with ArchiveWriter(args.archive, args.keyframe_interval) as writer:
+            for path in args.replays:
+                writer.add(replay.load(path))
+        print("packed {} rounds".format(len(args.replays)))
+
+    elif args.command == "info":
+        with ArchiveReader(args.archive) as reader:
+            print("{} rounds, a keyframe every {} ticks".format(len(reader), reader.keyframe_interval))
+            for i in range(len(reader)):
+                entry = reader.get_entry(i)
+                print("{:>6}: {} players, {} ticks, {} keyframes".format(i, entry[2], entry[6], entry[5]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,347 @@
+"""
+Benchmarks for the collision, AI and drawing hot paths.
+
+Everything runs on the same seeded 1pffa round with AI players in
+every seat. The round is measured early, in the middle and late,
+when there are more and more trails on the map. Pure functions are
+timed on inputs taken from the map. Player methods, like
+handle_input and check_collision, are timed while the round plays on
+for a while, the same way for each of their variants.
+
+    python benchmark.py --save-baseline      # remember the numbers
+    python benchmark.py                      # compare against them
+
+Results are written as json. When a baseline exists, every result
+is compared against it and the exit status is 1 if anything got
+slower by more than the tolerance. Drawing uses the dummy SDL video
+driver unless SDL_VIDEODRIVER says otherwise.
+"""
+
+import os
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import argparse
+import json
+import platform
+import random
+import statistics
+import sys
+import time
+
+import pygame
+
+import cycles
+
+
+SEED = 0
+GAME_MODE = "1pffa"
+
+# (name, tick) of the moments in the round that are measured
+PHASES = [("early", 300), ("mid", 2400), ("late", 4800)]
+# how many ticks are played for the methods timed during play
+WINDOW = 120
+
+# how many inputs the pure functions are timed on
+SAMPLES = 2000
+
+FONT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "DejaVuSansMono.ttf")
+
+
+def start_scenario(tick, free_run=True, occupancy=True):
+    # the benchmark round at tick, or None if it is over by then.
+    # free_run False uses the line probing AI, occupancy False the
+    # line geometry for collisions.
+    players = cycles.create_players(GAME_MODE, human_seats=False)
+    for p in players:
+        p.use_free_run = free_run
+
+    simulation = cycles.Simulation(players, occupancy=occupancy, free_run=free_run)
+    simulation.start_round(SEED)
+    while simulation.ticks < tick:
+        if simulation.step():
+            return None
+
+    return simulation
+
+
+def skip(name, tick):
+    print("round is over before tick {}, skipping {}".format(tick, name), file=sys.stderr)
+
+
+def time_calls(func, args_list, repeat=5):
+    # the best average time of one call over a few runs
+    best = None
+    for r in range(repeat):
+        start = time.perf_counter()
+        for args in args_list:
+            func(*args)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return {"us": best / len(args_list) * 1e6, "calls": len(args_list)}
+
+
+def summarize(durations):
+    # durations of single calls in seconds
+    return {"us": statistics.median(durations) * 1e6,
+            "mean_us": statistics.mean(durations) * 1e6,
+            "calls": len(durations)}
+
+
+def time_method_in_play(simulation, players, method_name):
+    # play WINDOW ticks and time every call of the method on the
+    # given players.
+    durations = []
+
+    def wrap(method):
+        def timed(*args):
+            start = time.perf_counter()
+            result = method(*args)
+            durations.append(time.perf_counter() - start)
+            return result
+        return timed
+
+    for p in players:
+        setattr(p, method_name, wrap(getattr(p, method_name)))
+
+    for i in range(WINDOW):
+        if simulation.step():
+            break
+
+    for p in players:
+        delattr(p, method_name)
+
+    return durations
+
+
+def bench_geometry(results):
+    # the old geometry functions, on lines and points from the middle
+    # of the round.
+    tick = PHASES[1][1]
+    simulation = start_scenario(tick, free_run=False)
+    if simulation is None:
+        skip("the geometry functions", tick)
+        return
+
+    game_map = simulation.game_map
+    rng = random.Random(SEED)
+
+    lines = []
+    for p in game_map.players:
+        lines.extend(p.trail.get_line(i) for i in range(len(p.trail)))
+    points = [(rng.randint(game_map.x, game_map.x + game_map.width),
+               rng.randint(game_map.y, game_map.y + game_map.height)) for i in range(SAMPLES)]
+
+    pairs = [(x, y, rng.choice(lines)) for x, y in points]
+    results["point_on_line"] = time_calls(cycles.point_on_line, pairs)
+    results["dist_to_line_segment"] = time_calls(cycles.dist_to_line_segment, pairs)
+
+    pairs = [(rng.choice(lines), rng.choice(lines)) for i in range(SAMPLES)]
+    results["line_through_line"] = time_calls(cycles.line_through_line, pairs)
+
+    pairs = [(rng.choice(lines), rng.choice(game_map.obstacles)) for i in range(SAMPLES)]
+    results["line_in_rect"] = time_calls(cycles.line_in_rect, pairs)
+
+
+def bench_phase(results, phase, tick):
+    simulation = start_scenario(tick, free_run=False)
+    if simulation is None:
+        skip("the {} phase".format(phase), tick)
+        return
+
+    # a pure call, on the state at tick
+    ais = [p for p in simulation.alive_players() if isinstance(p, cycles.AIPlayer)]
+    results["get_closest_lines/" + phase] = time_calls(
+        lambda p: p.get_closest_lines(30), [(p,) for p in ais] * 50)
+
+    # the two ways of each, timed the same way while the round plays
+    # on from tick
+    for name, free_run, occupancy in [("lines", False, False), ("grid", True, True)]:
+        simulation = start_scenario(tick, free_run, occupancy)
+        if simulation is None:
+            skip("check_collision/{}/{}".format(name, phase), tick)
+            continue
+        durations = time_method_in_play(simulation, simulation.alive_players(), "check_collision")
+        results["check_collision/{}/{}".format(name, phase)] = summarize(durations)
+
+    for name, free_run in [("lines", False), ("free_run", True)]:
+        simulation = start_scenario(tick, free_run)
+        if simulation is None:
+            skip("handle_input/{}/{}".format(name, phase), tick)
+            continue
+        ais = [p for p in simulation.alive_players() if isinstance(p, cycles.AIPlayer)]
+        durations = time_method_in_play(simulation, ais, "handle_input")
+        results["handle_input/{}/{}".format(name, phase)] = summarize(durations)
+
+    # whole ticks
+    for free_run, name in [(True, "free_run"), (False, "lines")]:
+        simulation = start_scenario(tick, free_run)
+        if simulation is None:
+            skip("tick/{}/{}".format(name, phase), tick)
+            continue
+        durations = []
+        for i in range(WINDOW):
+            start = time.perf_counter()
+            over = simulation.step()
+            durations.append(time.perf_counter() - start)
+            if over:
+                break
+        results["tick/{}/{}".format(name, phase)] = summarize(durations)
+
+    # MCTSPlayer rollouts from the state at tick, set up like the
+    # first player still alive would
+    simulation = start_scenario(tick)
+    if simulation is None:
+        skip("mcts/rollout/" + phase, tick)
+        return
+
+    defaults = cycles.MCTSPlayer(0, 0, pygame.Color(255, 255, 255), None)
+    me = simulation.alive_players()[0].trail_id - 1
+    arena = cycles.RolloutArena()
+    arena.load(simulation.game_map, me, 2 * defaults.horizon, defaults.edge_margin)
+    rng = random.Random(SEED)
+
+    def rollout():
+        arena.reset()
+        arena.play(me, [], 1, defaults.horizon, rng, defaults.turn_chance)
+
+    result = time_calls(rollout, [()] * (SAMPLES // 10))
+    result["rollouts_per_s"] = 1e6 / result["us"]
+    results["mcts/rollout/" + phase] = result
+
+
+def bench_frames(results, phase, tick, screen, font):
+    simulation = start_scenario(tick)
+    if simulation is None:
+        skip("the {} frames".format(phase), tick)
+        return
+
+    game_map = simulation.game_map
+    bar = cycles.TopBar(0, 0, 800, 100, font, simulation.players, GAME_MODE)
+
+    def frame():
+        dirty_rects = game_map.draw(screen)
+        dirty_rects.extend(bar.draw(screen, simulation.seconds_to_shrink()))
+        pygame.display.update(dirty_rects)
+
+    # a full redraw, like the first frame of a round
+    full = []
+    for i in range(20):
+        game_map.full_redraw = True
+        start = time.perf_counter()
+        frame()
+        full.append(time.perf_counter() - start)
+    results["frame/full/" + phase] = summarize(full)
+
+    # and the usual frames while the round goes on
+    durations = []
+    for i in range(WINDOW):
+        if simulation.step():
+            break
+        start = time.perf_counter()
+        frame()
+        durations.append(time.perf_counter() - start)
+    results["frame/" + phase] = summarize(durations)
+
+
+def run_benchmarks(with_frames=True):
+    results = {}
+    bench_geometry(results)
+    for phase, tick in PHASES:
+        bench_phase(results, phase, tick)
+
+    if with_frames:
+        pygame.display.init()
+        pygame.font.init()
+        screen = pygame.display.set_mode((800, 600))
+        font = pygame.font.Font(FONT_PATH, 18)
+        for phase, tick in PHASES:
+            bench_frames(results, phase, tick, screen, font)
+        pygame.display.quit()
+
+    return results
+
+
+def get_meta():
+    numpy_version = None
+    if cycles.numpy is not None:
+        numpy_version = cycles.numpy.__version__
+
+    return {"python": platform.python_version(),
+            "pygame": pygame.version.ver,
+            "numpy": numpy_version,
+            "machine": platform.machine(),
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "seed": SEED}
+
+
+def compare(results, baseline, tolerance):
+    # returns the (name, baseline us, new us, ratio) rows and
+    # the names that got slower than allowed.
+    rows = []
+    regressions = []
+    for name in sorted(results):
+        if not name in baseline:
+            continue
+        old = baseline[name]["us"]
+        new = results[name]["us"]
+        ratio = new / old if old > 0 else 1.0
+        rows.append((name, old, new, ratio))
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+
+    return rows, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the game's hot paths.")
+    parser.add_argument("--out", default="benchmark_results.json",
+                        help="where to write the results")
+    parser.add_argument("--baseline", default="benchmark_baseline.json",
+                        help="results to compare against")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="store these results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="how much slower than the baseline is still fine, 0.25 is 25%%")
+    parser.add_argument("--no-frames", action="store_true",
+                        help="skip the drawing benchmarks")
+    args = parser.parse_args()
+
+    results = run_benchmarks(not args.no_frames)
+    report = {"meta": get_meta(), "results": results}
+
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    baseline = None
+    if not args.save_baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+
+    if baseline is None:
+        for name in sorted(results):
+            print("{:<36}{:>12.2f} us".format(name, results[name]["us"]))
+        return 0
+
+    rows, regressions = compare(results, baseline, args.tolerance)
+    print("{:<36}{:>12}{:>12}{:>8}".format("", "baseline", "now", ""))
+    for name, old, new, ratio in rows:
+        flag = " slower" if name in regressions else ""
+        print("{:<36}{:>9.2f} us{:>9.2f} us{:>7.2f}x{}".format(name, old, new, ratio, flag))
+
+    if len(regressions) > 0:
+        print("{} benchmarks got slower than the baseline".format(len(regressions)))
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
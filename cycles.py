@@ -2,12 +2,25 @@
 import pygame
 import random
 import math
+import argparse
+import array
+import collections
+import json
+import time
+
+# numpy is optional, it only speeds up the AI
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # for the about page button
 import webbrowser
 
 
-all_events = None
+# the events of the current frame, filled in by play_game.
+# stays empty when running without a window.
+all_events = []
 
 def initialize(screen_width, screen_height):
     pygame.init()
@@ -35,7 +48,7 @@ p2_input = {"left": pygame.K_LEFT,
 
 
 class GameMap():
-    def __init__(self, x, y, w, h):
+    def __init__(self, x, y, w, h, seed=None):
         # these are the original measures, which will no be changed
         self.orig_x = x
         self.orig_y = y
@@ -61,35 +74,525 @@ class GameMap():
 
         # contains all the obstacles on the map
         self.obstacles = []
+        # the ones that can still be hit, bucketed by position. set_rect
+        # replaces it when some can't be hit anymore.
+        self.obstacle_index = ObstacleIndex()
+
+        # everything random on the map and its players comes from
+        # this, so the same seed plays out the same round.
+        self.seed = seed
+        self.rng = random.Random(seed)
+
+        # optional OccupancyGrid, see enable_occupancy
+        self.occupancy = None
+
+        # all the player trails' lines, bucketed by position
+        self.segment_index = SegmentIndex()
+
+        # numpy array of the obstacle_index rects, see get_obstacle_table
+        self.obstacle_table = None
+        # (map rect, line count per player, TerritoryBoard) shared by
+        # the TerritoryAIPlayers, see TerritoryAIPlayer.get_board
+        self.territory_board = None
+
+        # cached drawing layers, made on the first draw and after a
+        # shrink. the background has the fills and obstacles, the
+        # trail layer is a copy of it that the trails get drawn on.
+        self.background_layer = None
+        self.trail_layer = None
+        # player -> (lines drawn, end of the current line when drawn)
+        self.trail_progress = {}
+        # where the player circles were drawn on the screen
+        self.head_rects = []
+        # screen rects that something else drew over, see redraw_area
+        self.covered_rects = []
+        # draw everything on the next draw, e.g. after something
+        # else was drawn over the map
+        self.full_redraw = True
+        # when draw_view shows the whole map, it draws each trail as
+        # one polyline instead of looking up the lines in view
+        self.polylines = True
+
+    def alive_players(self):
+        # the players that haven't crashed yet
+        return [p for p in self.players if not p.crashed]
+
+    def add_player(self, player):
+        # trail ids start from 1, 0 is an empty cell in the grid
+        self.players.append(player)
+        player.game_map = self
+        player.trail_id = len(self.players)
+        player.reset_round_state()
+
+        for i in range(len(player.trail)):
+            self.segment_index.add(player.trail_id, player.trail, i)
+
+        if player.trail_id >= CELL_OBSTACLE:
+            raise Exception("too many players for one map")
+
+    def enable_occupancy(self, free_run=False):
+        # switch collision checks to an occupancy grid, built from
+        # everything that is already on the map. free_run also keeps
+        # FreeRunTables for the AI.
+        grid = OccupancyGrid(self.orig_x, self.orig_y, self.orig_width, self.orig_height)
+
+        for o in self.obstacles:
+            grid.fill_rect(o.x, o.y, o.w, o.h, CELL_OBSTACLE)
+        for p in self.players:
+            for i in range(len(p.trail)):
+                grid.mark_line(p.trail.get_line(i), p.trail_id)
+        # the tables in one go, instead of cell by cell while filling
+        if free_run:
+            grid.build_free_run()
+        grid.set_border(self.x, self.y, self.width, self.height)
+
+        self.occupancy = grid
+
+    def keep_undo_log(self, keep=True):
+        # start or stop logging the changes to the trail index and
+        # the occupancy grid, so that they can be taken back with undo
+        self.segment_index.undo_log = [] if keep else None
+        grid = self.occupancy
+        if grid is not None:
+            grid.undo_log = [] if keep else None
+            if grid.free_run is not None:
+                grid.free_run.undo_log = [] if keep else None
+
+    def get_undo_marks(self):
+        # how long the undo logs are now, for undo
+        marks = [len(self.segment_index.undo_log)]
+        grid = self.occupancy
+        if grid is not None:
+            marks.append(len(grid.undo_log))
+            if grid.free_run is not None:
+                marks.append(len(grid.free_run.undo_log))
+
+        return tuple(marks)
+
+    def undo(self, marks):
+        # take back everything logged since get_undo_marks
+        self.segment_index.undo(marks[0])
+        grid = self.occupancy
+        if grid is not None:
+            grid.undo(marks[1])
+            if grid.free_run is not None:
+                grid.free_run.undo(marks[2])
+
+        # the layers may have lines that are gone now, the board
+        # blocks that were taken since
+        self.trail_layer = None
+        self.territory_board = None
 
     def shrink(self, num):
         # reduce the map width and height by num
-        self.width -= num
-        self.height -= num
-        self.x += num // 2
-        self.y += num // 2
+        self.set_rect(self.x + num // 2, self.y + num // 2, self.width - num, self.height - num)
+
+    def set_rect(self, x, y, w, h):
+        # move the still-existing part of the map
+        self.x = x
+        self.y = y
+        self.width = w
+        self.height = h
         self.rect = pygame.Rect(self.x, self.y, self.width, self.height)
 
-    def fill_with_obstacles(self, num):
-        # randomly put num obstacles on the map
+        if self.occupancy is not None:
+            self.occupancy.set_border(self.x, self.y, self.width, self.height)
+
+        self.prune()
+
+        self.trail_layer = None
+
+    def prune(self):
+        # players can only be on the map rect and its far edges, going
+        # anywhere else is a crash. obstacles and trail lines that are
+        # completely outside of that can't be hit anymore, so they are
+        # dropped from the collision checks. they are still drawn.
+        # obstacles are tested with their edges reaching one past the
+        # rect (see get_bounding_lines), so those count as well.
+        x1 = self.x
+        y1 = self.y
+        x2 = self.x + self.width
+        y2 = self.y + self.height
+
+        # a new index rather than changing the old one, a snapshot
+        # may still have that
+        obstacles = self.obstacle_index.obstacles
+        live = []
+        for o in obstacles:
+            if o.x <= x2 and o.x + o.w >= x1 and o.y <= y2 and o.y + o.h >= y1:
+                live.append(o)
+        if len(live) != len(obstacles):
+            self.obstacle_index = ObstacleIndex(live)
+            self.obstacle_table = None
+
+        self.segment_index.prune(x1, y1, x2, y2)
+
+    def fill_with_obstacles(self, num, spawn_points=(), w=30, h=15, gap=10, spawn_clearance=60, tries=50):
+        """
+        spawn_points -> (x, y) of where the players start
+        gap -> free space around every obstacle, also to the map edges
+        spawn_clearance -> how far obstacles stay from the spawn points
+        tries -> how many random spots to try per obstacle
+        """
+        # randomly put up to num obstacles on the map, so that they
+        # don't touch and there is a way from every spawn point to
+        # every free part of the map. there can be fewer if the map
+        # gets too crowded.
+        layout = ObstacleIndex()
+        for o in self.obstacles:
+            layout.add(o)
+
+        placed = []
         for i in range(num):
-            x = random.randint(self.x, self.width)
-            y = random.randint(self.y, self.height)
-            w = 30
-            h = 15
+            for t in range(tries):
+                x = self.rng.randint(self.x + gap, self.x + self.width - w - gap)
+                y = self.rng.randint(self.y + gap, self.y + self.height - h - gap)
+
+                if len(layout.overlapping(x - gap, y - gap, x + w + gap, y + h + gap)) > 0:
+                    continue
+
+                near_spawn = False
+                for sx, sy in spawn_points:
+                    if x - spawn_clearance <= sx <= x + w + spawn_clearance and \
+                            y - spawn_clearance <= sy <= y + h + spawn_clearance:
+                        near_spawn = True
+                if near_spawn:
+                    continue
+
+                o = Obstacle(x, y, w, h)
+                layout.add(o)
+                placed.append(o)
+                break
+
+        # the gaps should keep everything connected, but if they
+        # don't, the last ones go until it is.
+        while len(placed) > 0 and not self.is_reachable(self.obstacles + placed, spawn_points):
+            placed.pop()
+
+        for o in placed:
+            self.add_obstacle(o.x, o.y, o.w, o.h)
+
+    def is_reachable(self, obstacles, spawn_points, step=5):
+        # flood fill the map in step by step squares, a square is
+        # blocked if any obstacle is on it. True if all the free
+        # squares and spawn points can be reached from each other.
+        cols = self.width // step + 1
+        rows = self.height // step + 1
+        blocked = bytearray(cols * rows)
+        for o in obstacles:
+            cx1 = max((o.x - self.x) // step, 0)
+            cy1 = max((o.y - self.y) // step, 0)
+            cx2 = min((o.x + o.w - 1 - self.x) // step, cols - 1)
+            cy2 = min((o.y + o.h - 1 - self.y) // step, rows - 1)
+            if cx1 > cx2:
+                continue
+            for cy in range(cy1, cy2 + 1):
+                i = cy * cols
+                blocked[i+cx1:i+cx2+1] = b"\x01" * (cx2 - cx1 + 1)
+
+        starts = []
+        for sx, sy in spawn_points:
+            cx = (sx - self.x) // step
+            cy = (sy - self.y) // step
+            if cx < 0 or cy < 0 or cx >= cols or cy >= rows or blocked[cy * cols + cx]:
+                return False
+            starts.append(cy * cols + cx)
+        if len(starts) == 0:
+            starts.append(blocked.find(0))
+            if starts[0] == -1:
+                return True
+
+        # the fill goes a run of free squares in a row at a time, a
+        # run reaches the ones it touches in the rows above and below
+        runs = []
+        for cy in range(rows):
+            row_runs = []
+            row = blocked[cy*cols:(cy+1)*cols]
+            a = row.find(0)
+            while a != -1:
+                b = row.find(1, a)
+                if b == -1:
+                    b = cols
+                row_runs.append((a, b))
+                a = row.find(0, b)
+            runs.append(row_runs)
+
+        cy = starts[0] // cols
+        cx = starts[0] % cols
+        first = [r for r in runs[cy] if r[0] <= cx < r[1]][0]
+        seen = {(cy, first[0])}
+        reached = 0
+        queue = collections.deque([(cy, first[0], first[1])])
+        while len(queue) > 0:
+            cy, a, b = queue.popleft()
+            reached += b - a
+            for ny in (cy - 1, cy + 1):
+                if ny < 0 or ny >= rows:
+                    continue
+                for na, nb in runs[ny]:
+                    if na < b and nb > a and not (ny, na) in seen:
+                        seen.add((ny, na))
+                        queue.append((ny, na, nb))
+
+        return reached == blocked.count(0)
+
+    def add_obstacle(self, x, y, w, h):
+        o = Obstacle(x, y, w, h)
+        self.obstacles.append(o)
+        self.obstacle_index.add(o)
+
+        if self.occupancy is not None:
+            self.occupancy.fill_rect(x, y, w, h, CELL_OBSTACLE)
+
+        self.obstacle_table = None
+
+    def get_obstacle_table(self):
+        # the obstacles in obstacle_index as rows of x, y, w, h,
+        # needs numpy
+        if self.obstacle_table is None:
+            rects = [(o.x, o.y, o.w, o.h) for o in self.obstacle_index.obstacles]
+            self.obstacle_table = numpy.array(rects, dtype=numpy.int64).reshape(-1, 4)
+
+        return self.obstacle_table
+
+    def build_layers(self):
+        # layers are in map coordinates, with orig_x, orig_y at 0, 0
+        offset = (-self.orig_x, -self.orig_y)
+
+        self.background_layer = pygame.Surface((self.orig_width, self.orig_height))
+        self.background_layer.fill(self.full_bkg)
+        self.background_layer.fill(self.field_bkg, self.rect.move(offset))
+        for o in self.obstacles:
+            self.background_layer.fill(o.color, o.rect.move(offset))
 
-            o = Obstacle(x, y, w, h)
-            self.obstacles.append(o)
+        self.trail_layer = self.background_layer.copy()
+        self.trail_progress = {}
+        for p in self.players:
+            self.draw_new_trail(p)
+
+        # the obstacles stay on top of the trails
+        for o in self.obstacles:
+            self.trail_layer.fill(o.color, o.rect.move(offset))
+
+        self.full_redraw = True
+
+    def draw_new_trail(self, player):
+        # draw the part of the trail that was added since the last
+        # call on the trail layer, returns the rects that changed
+        # in map coordinates.
+        ox = self.orig_x
+        oy = self.orig_y
+        trail = player.trail
+        x1, y1, x2, y2 = trail.x1, trail.y1, trail.x2, trail.y2
+        drawn, end_x, end_y = self.trail_progress.get(player, (0, 0, 0))
+
+        # the line that was current last time may have grown, the
+        # ones after it are new.
+        changed = []
+        if drawn > 0:
+            i = drawn - 1
+            if (x2[i], y2[i]) != (end_x, end_y):
+                r = pygame.draw.line(self.trail_layer, player.color, (end_x-ox, end_y-oy), (x2[i]-ox, y2[i]-oy))
+                changed.append(r)
+        if drawn < len(trail):
+            # all the new lines in one go, like a whole trail after
+            # the layers were made again
+            points = [(x - ox, y - oy) for x, y in trail.get_points()[drawn*2:]]
+            changed.append(pygame.draw.lines(self.trail_layer, player.color, False, points))
+
+        if len(trail) > 0:
+            self.trail_progress[player] = (len(trail), x2[-1], y2[-1])
+
+        return changed
+
+    def redraw_area(self, rect):
+        # put the map back under rect on the next draw, for things
+        # like overlays that are drawn on top of it.
+        self.covered_rects.append(pygame.Rect(rect))
 
     def draw(self, screen_surface):
-        screen_surface.fill(self.full_bkg, self.orig_rect)
-        screen_surface.fill(self.field_bkg, self.rect)
+        # only draws what changed since the last call, returns the
+        # list of rects that need updating on the display.
+        if self.trail_layer is None:
+            self.build_layers()
+
+        offset = (-self.orig_x, -self.orig_y)
+        dirty_rects = []
+
+        if self.full_redraw:
+            screen_surface.blit(self.trail_layer, self.orig_rect)
+            dirty_rects.append(self.orig_rect)
+            self.full_redraw = False
+        else:
+            # take the old player circles and anything drawn over
+            # the map off the screen
+            for r in self.head_rects + self.covered_rects:
+                r = r.clip(self.orig_rect)
+                screen_surface.blit(self.trail_layer, r, r.move(offset))
+                dirty_rects.append(r)
+        self.covered_rects = []
 
         for p in self.players:
-            p.draw(screen_surface)
+            for r in self.draw_new_trail(p):
+                # keep the obstacles on top, if a trail ended in one
+                screen_r = r.move(self.orig_x, self.orig_y)
+                for o in self.obstacle_index.overlapping_rect(screen_r):
+                    o_rect = o.rect.move(offset)
+                    self.trail_layer.blit(self.background_layer, o_rect, o_rect)
 
-        for o in self.obstacles:
-            o.draw(screen_surface)
+                screen_surface.blit(self.trail_layer, screen_r, r)
+                dirty_rects.append(screen_r)
+
+        self.head_rects = []
+        for p in self.players:
+            self.head_rects.append(p.draw_head(screen_surface))
+
+        for r in self.head_rects:
+            for o in self.obstacle_index.overlapping_rect(r):
+                o.draw(screen_surface)
+
+        dirty_rects.extend(self.head_rects)
+        return dirty_rects
+
+    def draw_view(self, screen_surface, camera):
+        # draw the part of the map the camera shows, from scratch.
+        # only the obstacles and lines in view get drawn, without the
+        # ones that were dropped when the map shrank (see prune).
+        # the whole map overview has everything in view, with
+        # polylines on it draws the trails like draw does instead.
+        # returns the list of rects that need updating.
+        camera.update(self)
+        x1, y1, x2, y2 = camera.get_view_bounds()
+        scale = camera.scale
+
+        screen_surface.set_clip(camera.rect)
+        screen_surface.fill(self.full_bkg, camera.rect)
+        screen_surface.fill(self.field_bkg, camera.to_screen_rect(self.x, self.y, self.width, self.height))
+
+        if self.polylines and camera.target is None:
+            # one call per player, like camera.to_screen without a
+            # call per point.
+            rx = camera.rect.x
+            ry = camera.rect.y
+            vx = camera.view_x
+            vy = camera.view_y
+            for p in self.players:
+                if len(p.trail) == 0:
+                    continue
+                points = [(rx + round((x - vx) * scale), ry + round((y - vy) * scale))
+                          for x, y in p.trail.get_points()]
+                pygame.draw.lines(screen_surface, p.color, False, points)
+        else:
+            segment_index = self.segment_index
+            for key in segment_index.in_rect(x1, y1, x2, y2):
+                trail, i = segment_index.get_trail(key)
+                color = self.players[(key & 255) - 1].color
+                start = camera.to_screen(trail.x1[i], trail.y1[i])
+                end = camera.to_screen(trail.x2[i], trail.y2[i])
+                pygame.draw.line(screen_surface, color, start, end)
+
+        radius = max(round(8 * scale), 2)
+        for p in self.players:
+            if x1 - 8 <= p.x <= x2 + 8 and y1 - 8 <= p.y <= y2 + 8:
+                pygame.draw.circle(screen_surface, p.color, camera.to_screen(p.x, p.y), radius, min(3, radius))
+
+        # the obstacles stay on top of the trails and players
+        for o in self.obstacle_index.overlapping(x1, y1, x2, y2):
+            screen_surface.fill(o.color, camera.to_screen_rect(o.x, o.y, o.w, o.h))
+
+        screen_surface.set_clip(None)
+
+        # everything under the view was drawn over, the layers start
+        # over if draw is used again
+        self.covered_rects = []
+        self.full_redraw = True
+        return [camera.rect]
+
+
+class Camera():
+    """
+    Shows a map that can be larger than the screen on the screen rect
+    x, y, w, h. It either follows a player at some zoom or shows the
+    whole map scaled down to fit.
+    """
+    def __init__(self, x, y, w, h):
+        self.rect = pygame.Rect(x, y, w, h)
+
+        # the player to follow, None shows the whole map
+        self.target = None
+        # how many screen pixels per map pixel when following
+        self.zoom = 1.0
+
+        # the top left of the map area shown and its scale, set by
+        # update
+        self.view_x = 0
+        self.view_y = 0
+        self.scale = 1.0
+
+    def follow_next(self, alive):
+        # follow the next of the players still going, after the last
+        # one show the whole map
+        if self.target in alive:
+            i = alive.index(self.target) + 1
+        else:
+            i = 0 if self.target is None else len(alive)
+
+        if i < len(alive):
+            self.target = alive[i]
+        else:
+            self.target = None
+
+    def change_zoom(self, factor):
+        self.zoom = min(max(self.zoom * factor, 0.25), 4.0)
+
+    def update(self, game_map):
+        map_x = game_map.orig_x
+        map_y = game_map.orig_y
+        map_w = game_map.orig_width
+        map_h = game_map.orig_height
+
+        if self.target is None:
+            self.scale = min(self.rect.w / map_w, self.rect.h / map_h)
+            center_x = map_x + map_w / 2
+            center_y = map_y + map_h / 2
+        else:
+            self.scale = self.zoom
+            center_x = self.target.x
+            center_y = self.target.y
+
+        view_w = self.rect.w / self.scale
+        view_h = self.rect.h / self.scale
+
+        # dont show past the edges of the map if it is big enough,
+        # otherwise keep it in the middle
+        if view_w < map_w:
+            center_x = min(max(center_x, map_x + view_w / 2), map_x + map_w - view_w / 2)
+        else:
+            center_x = map_x + map_w / 2
+        if view_h < map_h:
+            center_y = min(max(center_y, map_y + view_h / 2), map_y + map_h - view_h / 2)
+        else:
+            center_y = map_y + map_h / 2
+
+        self.view_x = center_x - view_w / 2
+        self.view_y = center_y - view_h / 2
+
+    def get_view_bounds(self):
+        # x1, y1, x2, y2 of the map area shown, edges included
+        x1 = math.floor(self.view_x)
+        y1 = math.floor(self.view_y)
+        x2 = math.ceil(self.view_x + self.rect.w / self.scale)
+        y2 = math.ceil(self.view_y + self.rect.h / self.scale)
+        return (x1, y1, x2, y2)
+
+    def to_screen(self, x, y):
+        return (self.rect.x + round((x - self.view_x) * self.scale),
+                self.rect.y + round((y - self.view_y) * self.scale))
+
+    def to_screen_rect(self, x, y, w, h):
+        # never less than a pixel, so small things stay visible
+        sx, sy = self.to_screen(x, y)
+        return pygame.Rect(sx, sy, max(round(w * self.scale), 1), max(round(h * self.scale), 1))
 
 
 class Obstacle():
@@ -123,6 +626,59 @@ class Obstacle():
         return [edge1, edge2, edge3, edge4]
 
 
+class ObstacleIndex():
+    """
+    Buckets obstacles by the square cells they cover, so only the
+    ones near a point, line or rect get tested. An obstacle counts
+    as reaching x + w and y + h, like its bounding lines do.
+    """
+    def __init__(self, obstacles=(), cell_size=64):
+        self.cell_size = cell_size
+
+        # everything added, in order
+        self.obstacles = []
+        # (cell x, cell y) -> list of obstacles
+        self.buckets = {}
+
+        for o in obstacles:
+            self.add(o)
+
+    def add(self, o):
+        self.obstacles.append(o)
+        s = self.cell_size
+        for cy in range(o.y // s, (o.y + o.h) // s + 1):
+            for cx in range(o.x // s, (o.x + o.w) // s + 1):
+                self.buckets.setdefault((cx, cy), []).append(o)
+
+    def overlapping(self, x1, y1, x2, y2):
+        # the obstacles that reach into x1, y1 - x2, y2, edges included
+        s = self.cell_size
+        found = []
+        for cy in range(y1 // s, y2 // s + 1):
+            for cx in range(x1 // s, x2 // s + 1):
+                for o in self.buckets.get((cx, cy), ()):
+                    if o.x <= x2 and o.x + o.w >= x1 and o.y <= y2 and o.y + o.h >= y1 and not o in found:
+                        found.append(o)
+
+        return found
+
+    def overlapping_rect(self, rect):
+        # the obstacles whose pygame rects collide with rect
+        if rect.w <= 0 or rect.h <= 0:
+            return []
+        found = self.overlapping(rect.x, rect.y, rect.right - 1, rect.bottom - 1)
+        return [o for o in found if o.rect.colliderect(rect)]
+
+    def find_point(self, x, y):
+        # True if (x, y) is inside an obstacle, like is_in_rect
+        s = self.cell_size
+        for o in self.buckets.get((x // s, y // s), ()):
+            if is_in_rect(x, y, o.x, o.y, o.w, o.h):
+                return True
+
+        return False
+
+
 class Line():
     def __init__(self, x1, y1, x2, y2):
         self.x1 = x1
@@ -131,6 +687,525 @@ class Line():
         self.y2 = y2
 
 
+class Trail():
+    """
+    The lines of a player's trail as four columns of ints, oldest
+    first, so the last row is the line currently being drawn. Adding
+    a line is an append and a row is 16 bytes.
+    """
+    def __init__(self):
+        self.x1 = array.array("i")
+        self.y1 = array.array("i")
+        self.x2 = array.array("i")
+        self.y2 = array.array("i")
+
+        # start and end of every line, for pygame.draw.lines, see
+        # get_points
+        self.points = []
+
+    def __len__(self):
+        return len(self.x1)
+
+    def add(self, x1, y1, x2, y2):
+        # returns the index of the new line
+        self.x1.append(x1)
+        self.y1.append(y1)
+        self.x2.append(x2)
+        self.y2.append(y2)
+        return len(self.x1) - 1
+
+    def set_end(self, x, y):
+        # move the end of the current line
+        self.x2[-1] = x
+        self.y2[-1] = y
+
+    def clear(self):
+        del self.x1[:]
+        del self.y1[:]
+        del self.x2[:]
+        del self.y2[:]
+        del self.points[:]
+
+    def truncate(self, n, end_x, end_y):
+        # go back to the first n lines, with the last one ending at
+        # end_x, end_y
+        del self.x1[n:]
+        del self.y1[n:]
+        del self.x2[n:]
+        del self.y2[n:]
+        del self.points[max(n - 1, 0) * 2:]
+        if n > 0:
+            self.set_end(end_x, end_y)
+
+    def get_points(self):
+        # the whole trail as one polyline, two points per line. a new
+        # line starts next to where the one before it ended, so the
+        # step between them draws nothing extra. only the lines added
+        # since the last call and the current one's end are updated.
+        points = self.points
+        i = max(len(points) // 2 - 1, 0)
+        del points[i*2:]
+        x1, y1, x2, y2 = self.x1, self.y1, self.x2, self.y2
+        for i in range(i, len(x1)):
+            points.append((x1[i], y1[i]))
+            points.append((x2[i], y2[i]))
+
+        return points
+
+    def get_row(self, i):
+        return (self.x1[i], self.y1[i], self.x2[i], self.y2[i])
+
+    def get_line(self, i):
+        # a copy, changing it does not change the trail
+        return Line(self.x1[i], self.y1[i], self.x2[i], self.y2[i])
+
+
+class SegmentIndex():
+    """
+    Buckets trail lines by the square cells their bounding box
+    covers, so looking for lines near a point only visits nearby
+    buckets. Lines are kept as keys, see make_key.
+    """
+    def __init__(self, cell_size=32):
+        self.cell_size = cell_size
+
+        # (cell x, cell y) -> array of keys
+        self.buckets = {}
+        # trail id -> Trail
+        self.trails = {}
+
+        # if not None, every change to the buckets goes in here so it
+        # can be undone, see undo. a cell means a key was added to its
+        # bucket, (cell, bucket) that the bucket was replaced or
+        # dropped and (cell, None) that it was new.
+        self.undo_log = None
+
+    def make_key(self, trail_id, i):
+        # line i of the trail, trail ids fit in a byte
+        return i * 256 + trail_id
+
+    def get_trail(self, key):
+        # (trail, line index) of a key
+        return self.trails[key & 255], key >> 8
+
+    def get_line(self, key):
+        trail, i = self.get_trail(key)
+        return trail.get_line(i)
+
+    def get_row(self, key):
+        trail, i = self.get_trail(key)
+        return trail.get_row(i)
+
+    def add_to_bucket(self, cell, key):
+        bucket = self.buckets.get(cell)
+        if bucket is None:
+            bucket = array.array("i")
+            self.buckets[cell] = bucket
+            if self.undo_log is not None:
+                self.undo_log.append((cell, None))
+        elif self.undo_log is not None:
+            self.undo_log.append(cell)
+        bucket.append(key)
+
+    def undo(self, n):
+        # take back the changes in the undo log after the first n
+        log = self.undo_log
+        buckets = self.buckets
+        while len(log) > n:
+            entry = log.pop()
+            if isinstance(entry[1], int):
+                buckets[entry].pop()
+            elif entry[1] is None:
+                del buckets[entry[0]]
+            else:
+                buckets[entry[0]] = entry[1]
+
+    def add(self, trail_id, trail, i):
+        self.trails[trail_id] = trail
+        key = self.make_key(trail_id, i)
+
+        s = self.cell_size
+        x1, y1, x2, y2 = trail.get_row(i)
+        for cy in range(min(y1, y2) // s, max(y1, y2) // s + 1):
+            for cx in range(min(x1, x2) // s, max(x1, x2) // s + 1):
+                self.add_to_bucket((cx, cy), key)
+
+    def extend(self, trail_id, i, x, y, old_x, old_y):
+        # the end of the line moved from (old_x, old_y) to (x, y) by
+        # one step, so it can have reached at most one new cell.
+        s = self.cell_size
+        cell = (x // s, y // s)
+        if cell != (old_x // s, old_y // s):
+            self.add_to_bucket(cell, self.make_key(trail_id, i))
+
+    def find_point(self, x, y, skip_key=None):
+        # True if any line but skip_key goes through (x, y), the same
+        # as point_on_line since the lines are always horizontal or
+        # vertical. only the bucket of the point can have them.
+        s = self.cell_size
+        for key in self.buckets.get((x // s, y // s), ()):
+            if key == skip_key:
+                continue
+
+            x1, y1, x2, y2 = self.get_row(key)
+            if ((x1 <= x <= x2) or (x2 <= x <= x1)) and ((y1 <= y <= y2) or (y2 <= y <= y1)):
+                return True
+
+        return False
+
+    def prune(self, x1, y1, x2, y2):
+        # forget the cells outside of x1, y1 - x2, y2 (edges included)
+        # and the lines that are completely outside of it. whatever
+        # is left of a line crossing the edge stays in the cells
+        # inside.
+        s = self.cell_size
+        log = self.undo_log
+        for cell in list(self.buckets):
+            cx, cy = cell
+            bucket = self.buckets[cell]
+            if cx * s > x2 or cx * s + s - 1 < x1 or cy * s > y2 or cy * s + s - 1 < y1:
+                del self.buckets[cell]
+                if log is not None:
+                    log.append((cell, bucket))
+                continue
+
+            keep = array.array("i")
+            for key in bucket:
+                lx1, ly1, lx2, ly2 = self.get_row(key)
+                if min(lx1, lx2) <= x2 and max(lx1, lx2) >= x1 and min(ly1, ly2) <= y2 and max(ly1, ly2) >= y1:
+                    keep.append(key)
+
+            if len(keep) == 0:
+                del self.buckets[cell]
+            elif len(keep) != len(bucket):
+                self.buckets[cell] = keep
+            else:
+                continue
+            if log is not None:
+                log.append((cell, bucket))
+
+    def in_rect(self, x1, y1, x2, y2):
+        # the keys of all the lines that reach into x1, y1 - x2, y2
+        s = self.cell_size
+        seen = set()
+        found = []
+        for cy in range(y1 // s, y2 // s + 1):
+            for cx in range(x1 // s, x2 // s + 1):
+                for key in self.buckets.get((cx, cy), ()):
+                    if key in seen:
+                        continue
+                    seen.add(key)
+
+                    lx1, ly1, lx2, ly2 = self.get_row(key)
+                    if min(lx1, lx2) <= x2 and max(lx1, lx2) >= x1 and min(ly1, ly2) <= y2 and max(ly1, ly2) >= y1:
+                        found.append(key)
+
+        return found
+
+    def near(self, x, y, distance):
+        # the keys of all the lines within distance of (x, y)
+        s = self.cell_size
+        seen = set()
+        nearby_lines = []
+        for cy in range((y - distance) // s, (y + distance) // s + 1):
+            for cx in range((x - distance) // s, (x + distance) // s + 1):
+                for key in self.buckets.get((cx, cy), ()):
+                    if key in seen:
+                        continue
+                    seen.add(key)
+
+                    if dist_to_line_segment(x, y, self.get_line(key)) <= distance:
+                        nearby_lines.append(key)
+
+        return nearby_lines
+
+
+# cell values of the occupancy grid. trails are stored as the
+# trail_id of the player that left them.
+CELL_FREE = 0
+CELL_OBSTACLE = 254
+CELL_BORDER = 255
+
+
+class OccupancyGrid():
+    """
+    One byte per position a player can be on, so collision checks
+    are a single lookup instead of a scan over every line.
+    """
+    def __init__(self, x, y, w, h, free_run=False):
+        # players only crash into the border past x+w and y+h,
+        # so those edges are still part of the grid.
+        self.x = x
+        self.y = y
+        self.w = w + 1
+        self.h = h + 1
+
+        self.cells = bytearray(self.w * self.h)
+
+        # optional FreeRunTable, kept up to date by mark and fill_rect
+        self.free_run = None
+        if free_run:
+            self.free_run = FreeRunTable(self.w, self.h)
+
+        # the part set_border left inside, as gx1, gy1, gx2, gy2
+        self.inside = (0, 0, self.w, self.h)
+
+        # if not None, the cells that change go in here so they can
+        # be put back, see undo. an int is a cell that was free, an
+        # (index, bytes) pair what was there before from index on.
+        self.undo_log = None
+
+    def get(self, x, y):
+        # everything outside the grid counts as border
+        gx = x - self.x
+        gy = y - self.y
+        if gx < 0 or gy < 0 or gx >= self.w or gy >= self.h:
+            return CELL_BORDER
+
+        return self.cells[gy * self.w + gx]
+
+    def mark(self, x, y, value):
+        # take a free cell, returns False if it was not free
+        gx = x - self.x
+        gy = y - self.y
+        if gx < 0 or gy < 0 or gx >= self.w or gy >= self.h:
+            return False
+
+        i = gy * self.w + gx
+        if self.cells[i] != CELL_FREE:
+            return False
+
+        self.cells[i] = value
+        if self.undo_log is not None:
+            self.undo_log.append(i)
+        if self.free_run is not None:
+            self.free_run.block(gx, gy)
+        return True
+
+    def save_cells(self, start, end):
+        # put cells start to end in the undo log before they change
+        if self.undo_log is not None and start < end:
+            self.undo_log.append((start, bytes(self.cells[start:end])))
+
+    def undo(self, n):
+        # put back the cells changed after the first n entries of the
+        # undo log. the free run tables have their own.
+        log = self.undo_log
+        cells = self.cells
+        while len(log) > n:
+            entry = log.pop()
+            if isinstance(entry, int):
+                cells[entry] = CELL_FREE
+            else:
+                start, saved = entry
+                cells[start:start+len(saved)] = saved
+
+    def get_free_run(self, x, y, direction):
+        # how many free cells follow (x, y) in direction, needs
+        # free_run. the border is not counted as blocking here.
+        gx = x - self.x
+        gy = y - self.y
+        if gx < 0 or gy < 0 or gx >= self.w or gy >= self.h:
+            return 0
+
+        return self.free_run.tables[direction][gy * self.w + gx]
+
+    def mark_line(self, line, value):
+        # lines are always horizontal or vertical
+        x1 = min(line.x1, line.x2)
+        x2 = max(line.x1, line.x2)
+        y1 = min(line.y1, line.y2)
+        y2 = max(line.y1, line.y2)
+        for y in range(y1, y2+1):
+            for x in range(x1, x2+1):
+                self.mark(x, y, value)
+
+    def fill_rect(self, x, y, w, h, value):
+        # same area that is_in_rect treats as inside
+        gx1 = max(x - self.x, 0)
+        gy1 = max(y - self.y, 0)
+        gx2 = min(x + w - self.x, self.w)
+        gy2 = min(y + h - self.y, self.h)
+        if gx1 >= gx2 or gy1 >= gy2:
+            return
+
+        if self.free_run is not None:
+            # cell by cell, so the tables see every newly blocked one
+            for gy in range(gy1, gy2):
+                for gx in range(gx1, gx2):
+                    self.mark(gx + self.x, gy + self.y, value)
+            return
+
+        row = bytes([value]) * (gx2 - gx1)
+        for gy in range(gy1, gy2):
+            i = gy * self.w
+            self.save_cells(i+gx1, i+gx2)
+            self.cells[i+gx1:i+gx2] = row
+
+    def build_free_run(self):
+        # make the FreeRunTable from the cells as they are now, before
+        # set_border made anything border
+        self.free_run = FreeRunTable(self.w, self.h)
+        self.free_run.build(self.cells)
+
+    def set_border(self, x, y, w, h):
+        # everything outside of the map rect becomes border, players
+        # can still be on its far edges (see Player.update).
+        # the free run tables leave this out, whoever reads them
+        # should cut the runs at the map rect themselves.
+        gx1 = min(max(x - self.x, 0), self.w)
+        gy1 = min(max(y - self.y, 0), self.h)
+        gx2 = min(max(x + w + 1 - self.x, gx1), self.w)
+        gy2 = min(max(y + h + 1 - self.y, gy1), self.h)
+
+        border = bytes([CELL_BORDER])
+        if gx1 == gx2:
+            gy2 = gy1
+
+        if self.undo_log is not None:
+            # only what was inside before can change
+            ox1, oy1, ox2, oy2 = self.inside
+            for gy in range(oy1, oy2):
+                i = gy * self.w
+                if gy < gy1 or gy >= gy2:
+                    self.save_cells(i+ox1, i+ox2)
+                else:
+                    self.save_cells(i+ox1, i+min(gx1, ox2))
+                    self.save_cells(i+max(gx2, ox1), i+ox2)
+        self.inside = (gx1, gy1, gx2, gy2)
+
+        self.cells[:gy1*self.w] = border * (gy1*self.w)
+        self.cells[gy2*self.w:] = border * ((self.h-gy2)*self.w)
+        for gy in range(gy1, gy2):
+            i = gy * self.w
+            self.cells[i:i+gx1] = border * gx1
+            self.cells[i+gx2:i+self.w] = border * (self.w-gx2)
+
+
+# 1 for every cell value except CELL_FREE, see FreeRunTable.build
+BLOCKED_BYTES = bytes([0] + [1] * 255)
+
+
+class FreeRunTable():
+    """
+    For every cell of an OccupancyGrid, the number of free cells
+    that follow it in each direction before a blocked cell or the
+    edge of the grid. Blocking a cell only rewrites the runs that
+    lead into it.
+    """
+    def __init__(self, w, h):
+        self.w = w
+        self.h = h
+
+        # runs of distances are copied out of these
+        n = max(w, h)
+        self.ramp_up = array.array("H", range(n))
+        self.ramp_down = array.array("H", range(n-1, -1, -1))
+
+        # on an empty grid every run goes to the edge
+        self.left = array.array("H", range(w)) * h
+        self.right = array.array("H", range(w-1, -1, -1)) * h
+        self.up = array.array("H")
+        self.down = array.array("H")
+        for gy in range(h):
+            self.up.extend(array.array("H", [gy]) * w)
+            self.down.extend(array.array("H", [h-1-gy]) * w)
+
+        self.tables = {"left": self.left,
+                       "right": self.right,
+                       "up": self.up,
+                       "down": self.down}
+
+        # if not None, (table, slice, old runs) for every run that
+        # block rewrites, see undo
+        self.undo_log = None
+
+    def build(self, cells):
+        # set all the runs for the cells of a grid, cells that aren't
+        # CELL_FREE are blocked. the same as blocking them one by one,
+        # but only the rows and columns with something in them are
+        # rewritten, a run at a time.
+        w = self.w
+        h = self.h
+        blocked = bytes(cells).translate(BLOCKED_BYTES)
+        for gy in range(h):
+            i = gy * w
+            line = blocked[i:i+w]
+            if line.find(1) != -1:
+                self.set_line(line, self.left, self.right, i, 1)
+        for gx in range(w):
+            line = blocked[gx::w]
+            if line.find(1) != -1:
+                self.set_line(line, self.up, self.down, gx, w)
+
+    def set_line(self, line, forward, back, start, step):
+        # the runs of one row or column. line has a 1 for every
+        # blocked cell, forward and back are the tables that count
+        # the free cells before and after each cell on it.
+        n = len(line)
+        ramp_len = len(self.ramp_down)
+        zeros = self.ramp_up[:1] * n
+
+        b = 0
+        while b < n:
+            a = line.find(0, b)
+            if a == -1:
+                a = n
+            # blocked cells from b to a, only the ones at the ends of
+            # this stretch have a free cell next to them
+            if a - b > 1:
+                forward[start+(b+1)*step:start+a*step:step] = zeros[:a-b-1]
+                back[start+b*step:start+(a-1)*step:step] = zeros[:a-b-1]
+            if a == n:
+                break
+
+            b = line.find(1, a)
+            if b == -1:
+                b = n
+            # the free cells from a to b, and the blocked cells on
+            # either side of them
+            k = min(b + 1, n)
+            forward[start+a*step:start+k*step:step] = self.ramp_up[:k-a]
+            k = max(a - 1, 0)
+            back[start+k*step:start+b*step:step] = self.ramp_down[ramp_len-(b-k):]
+
+    def block(self, gx, gy):
+        # the cell at gx, gy was free and is now blocked.
+        # the free cells before it (and the blocked cell before those)
+        # now run into it, and the free cells after it run into it
+        # when going back.
+        w = self.w
+        i = gy * w + gx
+        ramp_len = len(self.ramp_down)
+        log = self.undo_log
+
+        n = gx - max(gx - self.left[i] - 1, 0)
+        if log is not None:
+            log.append((self.right, slice(i-n, i), self.right[i-n:i]))
+        self.right[i-n:i] = self.ramp_down[ramp_len-n:]
+        n = min(gx + self.right[i] + 1, w - 1) - gx
+        if log is not None:
+            log.append((self.left, slice(i+1, i+1+n), self.left[i+1:i+1+n]))
+        self.left[i+1:i+1+n] = self.ramp_up[:n]
+
+        n = gy - max(gy - self.up[i] - 1, 0)
+        if log is not None:
+            log.append((self.down, slice(i-n*w, i, w), self.down[i-n*w:i:w]))
+        self.down[i-n*w:i:w] = self.ramp_down[ramp_len-n:]
+        n = min(gy + self.down[i] + 1, self.h - 1) - gy
+        if log is not None:
+            log.append((self.up, slice(i+w, i+w+n*w, w), self.up[i+w:i+w+n*w:w]))
+        self.up[i+w:i+w+n*w:w] = self.ramp_up[:n]
+
+    def undo(self, n):
+        # put back the runs changed after the first n entries of the
+        # undo log
+        log = self.undo_log
+        while len(log) > n:
+            table, where, runs = log.pop()
+            table[where] = runs
+
+
 class Button():
     def __init__(self, x, y, w, h, font, parent_surface, text="", action=None):
         self.x = x
@@ -430,6 +1505,78 @@ def line_in_rect(line, rect):
     return False
 
 
+def lines_through_lines(lines1, lines2):
+    """
+    lines1, lines2 -> numpy arrays with rows of x1, y1, x2, y2
+    """
+    # line_through_line for every pair of lines at once.
+    # returns an array of shape (len(lines1), len(lines2)).
+    a = lines1[:, None, :]
+    b = lines2[None, :, :]
+    ax1, ay1, ax2, ay2 = a[..., 0], a[..., 1], a[..., 2], a[..., 3]
+    bx1, by1, bx2, by2 = b[..., 0], b[..., 1], b[..., 2], b[..., 3]
+
+    # bounding_box_intersect
+    result = (numpy.minimum(ax1, ax2) <= numpy.maximum(bx1, bx2)) \
+        & (numpy.maximum(ax1, ax2) >= numpy.minimum(bx1, bx2)) \
+        & (numpy.minimum(ay1, ay2) <= numpy.maximum(by1, by2)) \
+        & (numpy.maximum(ay1, ay2) >= numpy.minimum(by1, by2))
+
+    # segment_crosses_line both ways. with integer coordinates it
+    # only fails when both ends are strictly on the same side at
+    # the same cross product.
+    dx = ax2 - ax1
+    dy = ay2 - ay1
+    c1 = dx * (by1 - ay1) - (bx1 - ax1) * dy
+    c2 = dx * (by2 - ay1) - (bx2 - ax1) * dy
+    result &= (c1 == 0) | (c1 != c2)
+
+    dx = bx2 - bx1
+    dy = by2 - by1
+    c1 = dx * (ay1 - by1) - (ax1 - bx1) * dy
+    c2 = dx * (ay2 - by1) - (ax2 - bx1) * dy
+    result &= (c1 == 0) | (c1 != c2)
+
+    return result
+
+
+def lines_in_rects(lines, rects):
+    """
+    lines -> numpy array with rows of x1, y1, x2, y2
+    rects -> numpy array with rows of x, y, w, h
+    """
+    # line_in_rect for every line and rect at once.
+    # returns an array of shape (len(lines), len(rects)).
+    x1 = lines[:, 0, None]
+    y1 = lines[:, 1, None]
+    x2 = lines[:, 2, None]
+    y2 = lines[:, 3, None]
+    rx1 = rects[None, :, 0]
+    ry1 = rects[None, :, 1]
+    rx2 = rx1 + rects[None, :, 2]
+    ry2 = ry1 + rects[None, :, 3]
+
+    # is_in_rect for both ends, see there for the - 1
+    result = (x1 >= rx1) & (x1 <= rx2 - 1) & (y1 >= ry1) & (y1 <= ry2 - 1)
+    result |= (x2 >= rx1) & (x2 <= rx2 - 1) & (y2 >= ry1) & (y2 <= ry2 - 1)
+
+    # the edges in the same order as Obstacle.get_bounding_lines
+    rx1 = rects[:, 0]
+    ry1 = rects[:, 1]
+    rx2 = rx1 + rects[:, 2]
+    ry2 = ry1 + rects[:, 3]
+    edges = numpy.stack([
+        numpy.stack([rx1, ry1, rx2, ry1], axis=1),
+        numpy.stack([rx1, ry1, rx1, ry2], axis=1),
+        numpy.stack([rx2, ry1, rx2, ry2], axis=1),
+        numpy.stack([rx1, ry2, rx2, ry2], axis=1)], axis=1).reshape(-1, 4)
+
+    crossed = lines_through_lines(lines, edges).reshape(len(lines), len(rects), 4)
+    result |= crossed.any(axis=2)
+
+    return result
+
+
 def algo_tests():
     # some tests to check whether line_through_line and
     # line_in_rect work correctly.
@@ -494,8 +1641,8 @@ class Player():
         self.direction = "up"
         self.input_dict = None
 
-        # the first element will always be the current trail
-        self.lines = []
+        # the last line of it is always the current one
+        self.trail = Trail()
 
         # hold a reference to the map you are on
         self.game_map = game_map
@@ -503,9 +1650,44 @@ class Player():
         # count your own score
         self.score = 0
 
+        # set by GameMap.add_player, used by the occupancy grid
+        self.trail_id = 0
+        # True when start_new_line took the current position in the
+        # occupancy grid, so it doesnt count as a crash into ourselves.
+        self.head_marked = False
+        # set by update, the player stays where it crashed
+        self.crashed = False
+
+    def reset_round_state(self):
+        # called when the player is put on a new map
+        self.head_marked = False
+        self.crashed = False
+
+    def save_state(self):
+        # everything that changes during a round, as a tuple, without
+        # the lines before the current one. those only get added to,
+        # so the number of them is enough to go back.
+        end_x = 0
+        end_y = 0
+        if len(self.trail) > 0:
+            end_x = self.trail.x2[-1]
+            end_y = self.trail.y2[-1]
+
+        return (self.x, self.y, self.direction, self.head_marked, self.score, len(self.trail), end_x, end_y)
+
+    def load_state(self, state):
+        # go back to a state from save_state, the map has to go back
+        # to the same moment (see GameMap.undo)
+        self.x, self.y, self.direction, self.head_marked, self.score, line_count, end_x, end_y = state[:8]
+        self.trail.truncate(line_count, end_x, end_y)
+
     def handle_input(self):
         global all_events
 
+        # players without controls just keep going straight
+        if self.input_dict is None:
+            return None
+
         valid_input = self.input_dict.values()
         user_input = None
 
@@ -519,9 +1701,12 @@ class Player():
         reversed_dict = {value: key for key, value in self.input_dict.items()}
         new_direction = reversed_dict[user_input]
 
-        # you cant go in reverse
+        # you cant go in reverse, and going on straight needs no
+        # new line
         if is_opposing_direction(new_direction, self.direction):
             return None
+        if new_direction == self.direction:
+            return None
 
         self.direction = new_direction
 
@@ -529,27 +1714,37 @@ class Player():
         self.start_new_line()
 
     def start_new_line(self):
-        new_line = Line(self.x, self.y, self.x, self.y)
-        self.lines.insert(0, new_line)
+        i = self.trail.add(self.x, self.y, self.x, self.y)
+        self.game_map.segment_index.add(self.trail_id, self.trail, i)
+
+        # the new line covers this position right away, so it is
+        # already there for the players updated before us.
+        grid = self.game_map.occupancy
+        if grid is not None:
+            self.head_marked = grid.mark(self.x, self.y, self.trail_id)
 
     def check_collision(self):
         status_good = "moving"
         status_crashed = "crashed"
 
-        # check for all the lines
-        all_lines = []
-        for p in self.game_map.players:
-            all_lines.extend(p.lines)
+        grid = self.game_map.occupancy
+        if grid is not None:
+            # the cell is either taken by our own new line, free (and
+            # now ours) or something we crashed into.
+            if self.head_marked:
+                self.head_marked = False
+                return status_good
+            if grid.mark(self.x, self.y, self.trail_id):
+                return status_good
+            return status_crashed
 
-        all_lines.remove(self.lines[0])
-        for line in all_lines:
-            if point_on_line(self.x, self.y, line):
-                return status_crashed
+        # check for all the lines, except the one we are drawing
+        if self.game_map.segment_index.find_point(self.x, self.y, self.get_current_key()):
+            return status_crashed
 
-        # check for all the obstacles
-        for o in self.game_map.obstacles:
-            if is_in_rect(self.x, self.y, o.x, o.y, o.w, o.h):
-                return status_crashed
+        # check for the obstacles
+        if self.game_map.obstacle_index.find_point(self.x, self.y):
+            return status_crashed
 
         return status_good
 
@@ -562,17 +1757,21 @@ class Player():
         map_w = self.game_map.width
         map_h = self.game_map.height
         if self.x < map_x or self.x > map_x+map_w or self.y < map_y or self.y > map_y+map_h:
+            self.crashed = True
             return status_crashed
 
-        if len(self.lines) == 0:
+        trail = self.trail
+        if len(trail) == 0:
             self.start_new_line()
         else:
-            current_line = self.lines[0]
-            current_line.x2 = self.x
-            current_line.y2 = self.y
+            old_x = trail.x2[-1]
+            old_y = trail.y2[-1]
+            trail.set_end(self.x, self.y)
+            self.game_map.segment_index.extend(self.trail_id, len(trail) - 1, self.x, self.y, old_x, old_y)
 
         collision = self.check_collision()
         if collision == "crashed":
+            self.crashed = True
             return status_crashed
 
         if self.direction == "up":
@@ -589,18 +1788,28 @@ class Player():
             return status_good
 
     def draw(self, screen_surface):
-        for line in self.lines:
-            pygame.draw.line(screen_surface, self.color, (line.x1, line.y1), (line.x2, line.y2))
-        pygame.draw.circle(screen_surface, self.color, (self.x, self.y), 8, 3)
+        if len(self.trail) > 0:
+            pygame.draw.lines(screen_surface, self.color, False, self.trail.get_points())
+        self.draw_head(screen_surface)
+
+    def get_current_key(self):
+        # the SegmentIndex key of the line we are drawing, or None
+        if len(self.trail) == 0:
+            return None
+        return self.game_map.segment_index.make_key(self.trail_id, len(self.trail) - 1)
+
+    def draw_head(self, screen_surface):
+        # returns the rect that was drawn on
+        return pygame.draw.circle(screen_surface, self.color, (self.x, self.y), 8, 3)
 
 
 class AIPlayer(Player):
     def __init__(self, x, y, color, game_map):
         super().__init__(x, y, color, game_map)
 
-        # player lines that will be used for collision detection
-        # to avoid iterating through every line on the map
-        # every game turn.
+        # keys of the player lines that will be used for collision
+        # detection to avoid iterating through every line on the map
+        # every game turn, see SegmentIndex.
         self.cached_lines = []
         self.turns_to_update_cache = 10
         self.cache_counter = 0
@@ -608,19 +1817,30 @@ class AIPlayer(Player):
         # this is re-randomized on every change of direction
         self.test_line_length = random.randint(11, 16)
 
+        # if False, probe lines even when the map keeps free run tables
+        self.use_free_run = True
+
+    def reset_round_state(self):
+        super().reset_round_state()
+
+        # nothing from the previous round should carry over
+        self.cached_lines = []
+        self.cache_counter = 0
+        self.test_line_length = self.game_map.rng.randint(11, 16)
+
+    def save_state(self):
+        # the line cache is replaced, never changed, so it can be shared
+        return super().save_state() + (self.cached_lines, self.cache_counter, self.test_line_length)
+
+    def load_state(self, state):
+        super().load_state(state)
+        self.cached_lines, self.cache_counter, self.test_line_length = state[8:]
+
     def get_closest_lines(self, distance):
         # this also returns the line you are currently on
-        lines = []
-        for p in self.game_map.players:
-            lines.extend(p.lines)
+        nearby_lines = self.game_map.segment_index.near(self.x, self.y, distance)
 
-        nearby_lines = []
-        for l in lines:
-            dist = dist_to_line_segment(self.x, self.y, l)
-            if dist <= distance:
-                nearby_lines.append(l)
-
-        #print("updated cache: {} lines cached from a total of {}".format(len(nearby_lines), len(lines)))
+        #print("updated cache: {} lines cached".format(len(nearby_lines)))
         return nearby_lines
 
     def update(self):
@@ -630,7 +1850,10 @@ class AIPlayer(Player):
         # turns_to_update_cache should also not be too large.
         max_line_dist = 30
 
-        if self.cache_counter == self.turns_to_update_cache:
+        # the line cache is not needed when free run tables are kept
+        if self.has_free_run():
+            pass
+        elif self.cache_counter == self.turns_to_update_cache:
             self.cached_lines = self.get_closest_lines(max_line_dist)
             self.cache_counter = 0
         else:
@@ -656,27 +1879,68 @@ class AIPlayer(Player):
             return False
 
         # remove own line as it would always cause errors later
-        current_line = None
-        if len(self.lines) > 0:
-            current_line = self.lines[0]
-        for line in self.cached_lines:
-            if line is current_line:
+        segment_index = self.game_map.segment_index
+        current_key = self.get_current_key()
+        for key in self.cached_lines:
+            if key == current_key:
                 continue
 
+            line = segment_index.get_line(key)
             if line_through_line(linearg, line):
                 # print("line goes through another line")
                 # print("linearg: {}, {}, {}, {}".format(linearg.x1, linearg.y1, linearg.x2, linearg.y2))
                 # print("problem line: {}, {}, {}, {}".format(line.x1, line.y1, line.x2, line.y2))
                 return False
 
-        # check for all the obstacles
-        for o in self.game_map.obstacles:
+        # check for the obstacles around the line
+        x1 = min(linearg.x1, linearg.x2)
+        y1 = min(linearg.y1, linearg.y2)
+        x2 = max(linearg.x1, linearg.x2)
+        y2 = max(linearg.y1, linearg.y2)
+        for o in self.game_map.obstacle_index.overlapping(x1, y1, x2, y2):
             if line_in_rect(linearg, o):
                 # print("line goes through obstacle")
                 return False
 
         return True
 
+    def lines_are_clear(self, lines):
+        # line_is_clear for many lines at once, needs numpy.
+        # returns a list of bools.
+        probes = numpy.array([(l.x1, l.y1, l.x2, l.y2) for l in lines], dtype=numpy.int64)
+        x1 = probes[:, 0]
+        y1 = probes[:, 1]
+        x2 = probes[:, 2]
+        y2 = probes[:, 3]
+
+        # map bounds, the same as is_in_rect
+        x = self.game_map.x
+        y = self.game_map.y
+        w = self.game_map.width
+        h = self.game_map.height
+        clear = (x1 >= x) & (x1 <= x+w-1) & (y1 >= y) & (y1 <= y+h-1) \
+            & (x2 >= x) & (x2 <= x+w-1) & (y2 >= y) & (y2 <= y+h-1)
+
+        segment_index = self.game_map.segment_index
+        current_key = self.get_current_key()
+        trail = [segment_index.get_row(key) for key in self.cached_lines if key != current_key]
+        if len(trail) > 0:
+            trail = numpy.array(trail, dtype=numpy.int64)
+            clear &= ~lines_through_lines(probes, trail).any(axis=1)
+
+        # only the obstacles around the probes
+        rects = self.game_map.get_obstacle_table()
+        if len(rects) > 0:
+            near = (rects[:, 0] <= max(x1.max(), x2.max())) \
+                & (rects[:, 0] + rects[:, 2] >= min(x1.min(), x2.min())) \
+                & (rects[:, 1] <= max(y1.max(), y2.max())) \
+                & (rects[:, 1] + rects[:, 3] >= min(y1.min(), y2.min()))
+            rects = rects[near]
+        if len(rects) > 0:
+            clear &= ~lines_in_rects(probes, rects).any(axis=1)
+
+        return clear.tolist()
+
     def get_line_in_direction(self, direction, length):
         # get a line that goes from current coordinates
         # in the given direction with the given length.
@@ -700,6 +1964,36 @@ class AIPlayer(Player):
 
         return Line(x1, y1, x2, y2)
 
+    def has_free_run(self):
+        grid = self.game_map.occupancy
+        return self.use_free_run and grid is not None and grid.free_run is not None
+
+    def get_free_length(self, direction):
+        # the longest line in direction that line_is_clear would
+        # pass, read from the free run tables. -1 if not even a
+        # zero length line would.
+        x = self.game_map.x
+        y = self.game_map.y
+        w = self.game_map.width
+        h = self.game_map.height
+        if not is_in_rect(self.x, self.y, x, y, w, h):
+            return -1
+
+        # the tables dont know about the border
+        if direction == "up":
+            map_free = self.y - y
+        elif direction == "down":
+            map_free = y + h - 1 - self.y
+        elif direction == "left":
+            map_free = self.x - x
+        elif direction == "right":
+            map_free = x + w - 1 - self.x
+        else:
+            raise Exception("invalid direction: "+direction)
+
+        free = self.game_map.occupancy.get_free_run(self.x, self.y, direction)
+        return min(free, map_free)
+
     def get_possible_directions(self):
         # all the directions in which we can turn
         possible_directions = ["up", "down", "left", "right"]
@@ -721,20 +2015,42 @@ class AIPlayer(Player):
     def handle_input(self):
         possible_directions = self.get_possible_directions()
 
-        test_line = self.get_line_in_direction(self.direction, self.test_line_length)
-        if self.line_is_clear(test_line):
-            return None
+        # with free run tables, how far we can go is a lookup
+        free_lengths = None
+        if self.has_free_run():
+            if self.get_free_length(self.direction) >= self.test_line_length:
+                return None
+            free_lengths = {d: self.get_free_length(d) for d in possible_directions}
+        else:
+            test_line = self.get_line_in_direction(self.direction, self.test_line_length)
+            if self.line_is_clear(test_line):
+                return None
+
+        # with numpy, test all the lines the loop below
+        # could ask for in one go.
+        clear_lines = None
+        if free_lengths is None and numpy is not None:
+            wanted = [(d, length) for length in range(240, -1, -10) for d in possible_directions]
+            lines = [self.get_line_in_direction(d, length) for d, length in wanted]
+            clear_lines = dict(zip(wanted, self.lines_are_clear(lines)))
 
         wanted_free_length = 250
         direction_to_go = None
         while direction_to_go is None:
             wanted_free_length -= 10
             if wanted_free_length < 10:
-                direction_to_go = random.choice(possible_directions)
+                direction_to_go = self.game_map.rng.choice(possible_directions)
 
             for d in possible_directions:
-                line = self.get_line_in_direction(d, wanted_free_length)
-                if self.line_is_clear(line):
+                if free_lengths is not None:
+                    clear = free_lengths[d] >= wanted_free_length
+                elif clear_lines is not None:
+                    clear = clear_lines[(d, wanted_free_length)]
+                else:
+                    line = self.get_line_in_direction(d, wanted_free_length)
+                    clear = self.line_is_clear(line)
+
+                if clear:
                     direction_to_go = d
 
         self.direction = direction_to_go
@@ -743,7 +2059,7 @@ class AIPlayer(Player):
         #print("ai: obstacles in the way, changing direction to:", self.direction)
 
         # re-randomize test line length
-        self.test_line_length = random.randint(11, 16)
+        self.test_line_length = self.game_map.rng.randint(11, 16)
 
         # you cant go in reverse
         #if is_opposing_direction(new_direction, self.direction):
@@ -751,6 +2067,636 @@ class AIPlayer(Player):
 
 
 
+class TerritoryBoard():
+    """
+    The map at a coarse resolution as one big int, a bit per block of
+    block x block pixels, set if the whole block is free. Flood fills
+    on it move every front one block per step with a few shifts, so
+    a whole map takes a few hundred big int operations. Needs numpy.
+    """
+    def __init__(self, game_map, block=8):
+        grid = game_map.occupancy
+        self.block = block
+        self.x = grid.x
+        self.y = grid.y
+        self.w = -(-grid.w // block)
+        self.h = -(-grid.h // block)
+
+        # pad the grid with border up to whole blocks
+        cells = numpy.full((self.h * block, self.w * block), CELL_BORDER, dtype=numpy.uint8)
+        cells[:grid.h, :grid.w] = numpy.frombuffer(grid.cells, dtype=numpy.uint8).reshape(grid.h, grid.w)
+        blocked = cells.reshape(self.h, block, self.w, block).max(axis=3).max(axis=1) != CELL_FREE
+
+        # bit y * w + x is block x, y
+        bits = numpy.packbits(~blocked.reshape(-1), bitorder="little")
+        self.free = int.from_bytes(bits.tobytes(), "little")
+
+        # shifting by one moves blocks to the next or previous column,
+        # these keep them from wrapping around to the next row
+        left_column = int.from_bytes(numpy.packbits(numpy.tile(numpy.arange(self.w) == 0, self.h),
+                                                    bitorder="little").tobytes(), "little")
+        right_column = left_column << (self.w - 1)
+        self.free_not_left = self.free & ~left_column
+        self.free_not_right = self.free & ~right_column
+
+    def get_line_bits(self, x1, y1, x2, y2):
+        # the bits of the blocks a straight line goes through
+        bx1 = max((min(x1, x2) - self.x) // self.block, 0)
+        by1 = max((min(y1, y2) - self.y) // self.block, 0)
+        bx2 = min((max(x1, x2) - self.x) // self.block, self.w - 1)
+        by2 = min((max(y1, y2) - self.y) // self.block, self.h - 1)
+        if bx1 > bx2:
+            return 0
+
+        row = ((1 << (bx2 - bx1 + 1)) - 1) << bx1
+        bits = 0
+        for by in range(by1, by2 + 1):
+            bits |= row << (by * self.w)
+        return bits
+
+    def take(self, bits):
+        # the blocks in bits are not free anymore
+        self.free &= ~bits
+        self.free_not_left &= ~bits
+        self.free_not_right &= ~bits
+
+    def get_bit(self, x, y):
+        # the bit of the block that has x, y in it, 0 if off the board
+        bx = (x - self.x) // self.block
+        by = (y - self.y) // self.block
+        if bx < 0 or by < 0 or bx >= self.w or by >= self.h:
+            return 0
+        return 1 << (by * self.w + bx)
+
+    def split(self, mine, theirs, max_steps):
+        # flood fill from the blocks in mine and theirs at the same
+        # time, a block goes to whoever gets there first and to
+        # nobody on a tie. returns how many blocks mine got.
+        w = self.w
+        taken = mine | theirs
+        free = self.free | taken
+        free_not_left = self.free_not_left | taken
+        free_not_right = self.free_not_right | taken
+
+        for i in range(max_steps):
+            grow_mine = ((mine << 1) & free_not_left) | ((mine >> 1) & free_not_right) \
+                | (((mine << w) | (mine >> w)) & free)
+            grow_theirs = ((theirs << 1) & free_not_left) | ((theirs >> 1) & free_not_right) \
+                | (((theirs << w) | (theirs >> w)) & free)
+            grow_mine &= ~taken
+            grow_theirs &= ~taken
+            if grow_mine == 0 and grow_theirs == 0:
+                break
+
+            tie = grow_mine & grow_theirs
+            mine |= grow_mine & ~tie
+            theirs |= grow_theirs & ~tie
+            taken |= grow_mine | grow_theirs
+
+        return bin(mine).count("1")
+
+
+class TerritoryAIPlayer(AIPlayer):
+    """
+    Picks its way by how much of the map it would have to itself. Every
+    few ticks, and whenever the way ahead gets short, each direction it
+    can go is scored by splitting the map between it and the other
+    players (see TerritoryBoard.split) as if it went one block that way.
+    Needs numpy and an occupancy grid, plays like AIPlayer without them.
+    """
+    def __init__(self, x, y, color, game_map):
+        super().__init__(x, y, color, game_map)
+
+        # how often to look for a better way, and how far to look
+        self.think_ticks = 12
+        self.max_steps = 40
+        # a turn has to win this much more than going on straight
+        self.turn_margin = 1.05
+
+        self.think_counter = 0
+
+    def reset_round_state(self):
+        super().reset_round_state()
+
+        # spread the thinking of the AIs over different ticks
+        self.think_counter = self.trail_id % self.think_ticks
+
+    def save_state(self):
+        return super().save_state() + (self.think_counter,)
+
+    def load_state(self, state):
+        super().load_state(state[:-1])
+        self.think_counter = state[-1]
+
+    def get_board(self):
+        # one board for everyone on the map. it is made again when
+        # the map shrinks, otherwise only the blocks under the lines
+        # added since are taken off it. every cell of a trail line
+        # is taken, so that gives the same board.
+        game_map = self.game_map
+        players = game_map.players
+        rect = (game_map.x, game_map.y, game_map.width, game_map.height)
+        cached = game_map.territory_board
+        if cached is None or cached[0] != rect or len(cached[1]) != len(players):
+            cached = (rect, [len(p.trail) for p in players], TerritoryBoard(game_map))
+            game_map.territory_board = cached
+            return cached[2]
+
+        counts = cached[1]
+        board = cached[2]
+        bits = 0
+        for i, p in enumerate(players):
+            trail = p.trail
+            # the line that was last then may have grown
+            for j in range(max(counts[i] - 1, 0), len(trail)):
+                bits |= board.get_line_bits(trail.x1[j], trail.y1[j], trail.x2[j], trail.y2[j])
+            counts[i] = len(trail)
+        if bits:
+            board.take(bits)
+
+        return board
+
+    def get_clear_length(self, direction, limit):
+        # how many free positions follow ours in direction, up to limit
+        if self.has_free_run():
+            return min(self.get_free_length(direction), limit)
+
+        grid = self.game_map.occupancy
+        x = self.game_map.x
+        y = self.game_map.y
+        w = self.game_map.width
+        h = self.game_map.height
+        dx, dy = {"up": (0, -1), "down": (0, 1), "left": (-1, 0), "right": (1, 0)}[direction]
+        px = self.x
+        py = self.y
+        for length in range(limit):
+            px += dx
+            py += dy
+            if not is_in_rect(px, py, x, y, w, h) or grid.get(px, py) != CELL_FREE:
+                return length
+
+        return limit
+
+    def get_opponent_bits(self, board):
+        # the blocks of the other players that are still moving
+        bits = 0
+        for p in self.game_map.alive_players():
+            if p is self:
+                continue
+            bits |= board.get_bit(p.x, p.y)
+
+        return bits
+
+    def handle_input(self):
+        if numpy is None or self.game_map.occupancy is None:
+            return super().handle_input()
+
+        look_ahead = self.test_line_length
+        ahead = self.get_clear_length(self.direction, look_ahead)
+
+        self.think_counter += 1
+        if ahead >= look_ahead and self.think_counter < self.think_ticks:
+            return None
+        self.think_counter = 0
+
+        board = self.get_board()
+        theirs = self.get_opponent_bits(board)
+        step = board.block
+
+        best_direction = None
+        best_score = -1
+        for d in [self.direction] + self.get_possible_directions():
+            clear = self.get_clear_length(d, look_ahead)
+            if clear == 0:
+                continue
+
+            # as if we went up to a block that way
+            line = self.get_line_in_direction(d, min(clear, step))
+            mine = board.get_bit(line.x2, line.y2)
+            score = board.split(mine, theirs & ~mine, self.max_steps)
+            # the board can't see gaps smaller than a block, a short
+            # way is likely a dead end
+            score *= clear / look_ahead
+            # keep going straight unless a turn is clearly better
+            if d == self.direction:
+                score *= self.turn_margin
+            if score > best_score:
+                best_direction = d
+                best_score = score
+
+        # boxed in, nothing to do about it
+        if best_direction is None or best_direction == self.direction:
+            return None
+
+        self.direction = best_direction
+        self.start_new_line()
+
+
+# the directions of the rollouts, clockwise, so turning right is +1
+ROLLOUT_DIRECTIONS = ["up", "right", "down", "left"]
+# how many free cells around a player a rollout looks for at its end
+ROLLOUT_ROOM = 64
+
+
+class RolloutArena():
+    """
+    A scratch copy of the occupancy grid for playing a round ahead,
+    with the rules of Player.update and check_collision: a player
+    takes the cell it is on or crashes, then moves on. The grid gets
+    two rings of border so nobody can move or look off it, and every
+    cell taken is logged so reset can free it again. The buffers are
+    made once and reused, so rollouts don't allocate anything.
+    """
+    def __init__(self):
+        self.cells = bytearray()
+        self.w = 0
+        # how far one step in each of ROLLOUT_DIRECTIONS is in cells
+        self.steps = [0, 0, 0, 0]
+
+        # per player on the map, at the start and while playing
+        self.start_pos = []
+        self.start_dirs = []
+        self.start_alive = []
+        self.start_marked = []
+        self.pos = []
+        self.dirs = []
+        self.alive = []
+        # players that took their cell by turning, this tick
+        self.marked = []
+        # players left out for being too far away, they count as alive
+        self.frozen = 0
+        # x1, y1, x2, y2 of where a rollout should end, see load
+        self.inner = (0, 0, 0, 0)
+
+        # the cells taken since the last reset
+        self.taken = array.array("i")
+        self.taken_count = 0
+
+    def load(self, game_map, me=None, reach=None, margin=0):
+        """
+        me -> index of the player the rollouts are for
+        reach -> players further than this from me are left out
+        margin -> how wide the edge of the map is that rollouts
+        should not end in
+        """
+        # copy the map as it is now, needs an occupancy grid. two
+        # players more than twice the ticks of a rollout apart can't
+        # get in each other's way in it.
+        grid = game_map.occupancy
+        w = grid.w + 4
+        h = grid.h + 4
+        if len(self.cells) != w * h:
+            self.cells = bytearray([CELL_BORDER]) * (w * h)
+        cells = self.cells
+        source = memoryview(grid.cells)
+        for gy in range(grid.h):
+            i = (gy + 2) * w + 2
+            cells[i:i+grid.w] = source[gy*grid.w:(gy+1)*grid.w]
+        self.w = w
+        self.steps = [-w, 1, w, -1]
+        self.taken_count = 0
+
+        # the part of the map away from the edge, in arena cells
+        gx1, gy1, gx2, gy2 = grid.inside
+        self.inner = (gx1 + 2 + margin, gy1 + 2 + margin, gx2 + 2 - margin, gy2 + 2 - margin)
+
+        players = game_map.players
+        self.start_pos[:] = [0] * len(players)
+        self.start_dirs[:] = [0] * len(players)
+        self.start_alive[:] = [False] * len(players)
+        self.start_marked[:] = [False] * len(players)
+        self.frozen = 0
+        for p in game_map.alive_players():
+            i = p.trail_id - 1
+            gx = p.x - grid.x
+            gy = p.y - grid.y
+            if gx < -1 or gy < -1 or gx > grid.w or gy > grid.h:
+                continue
+            if reach is not None and abs(p.x - players[me].x) + abs(p.y - players[me].y) > reach:
+                self.frozen += 1
+                continue
+
+            self.start_pos[i] = (gy + 2) * w + gx + 2
+            self.start_dirs[i] = ROLLOUT_DIRECTIONS.index(p.direction)
+            self.start_alive[i] = True
+            # it may have turned already this tick
+            self.start_marked[i] = p.head_marked
+
+        self.pos[:] = self.start_pos
+        self.dirs[:] = self.start_dirs
+        self.alive[:] = self.start_alive
+        self.marked[:] = self.start_marked
+
+    def reset(self):
+        # back to how load left it
+        cells = self.cells
+        taken = self.taken
+        for i in range(self.taken_count):
+            cells[taken[i]] = CELL_FREE
+        self.taken_count = 0
+
+        self.pos[:] = self.start_pos
+        self.dirs[:] = self.start_dirs
+        self.alive[:] = self.start_alive
+        self.marked[:] = self.start_marked
+
+    def play(self, me, plan, plan_ticks, horizon, rng, turn_chance):
+        """
+        me -> index of the player the rollout is for
+        plan -> the directions me goes in first, plan_ticks ticks each
+        turn_chance -> how likely the others (and me after the plan)
+        are to turn on a tick when the way ahead is free
+        """
+        # play up to horizon ticks from the current state. returns 1
+        # if me is the last one left, less the sooner me crashes or
+        # if me ends up at the edge of the map.
+        cells = self.cells
+        steps = self.steps
+        pos = self.pos
+        dirs = self.dirs
+        alive = self.alive
+        marked = self.marked
+        taken = self.taken
+        count = self.taken_count
+        random = rng.random
+
+        n = len(pos)
+        left = alive.count(True) + self.frozen
+        need = count + (horizon + 1) * n
+        if len(taken) < need:
+            taken.extend(array.array("i", bytes(4 * (need - len(taken)))))
+
+        planned = len(plan) * plan_ticks
+        for t in range(horizon):
+            # everyone turns before anyone moves, like Simulation.step
+            for j in range(n):
+                if not alive[j]:
+                    continue
+
+                p = pos[j]
+                d = dirs[j]
+                if j == me and t < planned:
+                    # the plan, unless it runs into something later on.
+                    # the first move is the one being tried out.
+                    nd = plan[t // plan_ticks]
+                    dodge = t > 0 and cells[p + steps[nd]] != CELL_FREE
+                else:
+                    nd = d
+                    dodge = cells[p + steps[d]] != CELL_FREE or random() < turn_chance
+
+                if dodge:
+                    a = (nd + 1) & 3
+                    b = (nd + 3) & 3
+                    if random() < 0.5:
+                        a, b = b, a
+                    if cells[p + steps[a]] == CELL_FREE:
+                        nd = a
+                    elif cells[p + steps[b]] == CELL_FREE:
+                        nd = b
+
+                if nd != d:
+                    dirs[j] = nd
+                    # a new line takes its cell right away
+                    if cells[p] == CELL_FREE:
+                        cells[p] = j + 1
+                        taken[count] = p
+                        count += 1
+                        marked[j] = True
+
+            for j in range(n):
+                if not alive[j]:
+                    continue
+
+                p = pos[j]
+                if marked[j]:
+                    marked[j] = False
+                elif cells[p] == CELL_FREE:
+                    cells[p] = j + 1
+                    taken[count] = p
+                    count += 1
+                else:
+                    alive[j] = False
+                    left -= 1
+                    if j == me:
+                        self.taken_count = count
+                        return 0.6 * t / horizon
+                    continue
+
+                pos[j] = p + steps[dirs[j]]
+
+            if left == 1:
+                self.taken_count = count
+                return 1.0
+
+        self.taken_count = count
+
+        # still going, better with more room around
+        p = pos[me]
+        room = 0
+        for step in steps:
+            i = p + step
+            while room < ROLLOUT_ROOM and cells[i] == CELL_FREE:
+                room += 1
+                i += step
+        reward = 0.6 + 0.2 * room / ROLLOUT_ROOM
+
+        x1, y1, x2, y2 = self.inner
+        x = p % self.w
+        y = p // self.w
+        if x < x1 or y < y1 or x >= x2 or y >= y2:
+            reward *= 0.5
+        return reward
+
+
+class MCTSPlayer(AIPlayer):
+    """
+    Searches for its next move with Monte-Carlo tree search. A tree of
+    its own moves, each held for a few ticks, is grown with UCT, and
+    every node is scored by rollouts on a RolloutArena in which the
+    others (and then itself) move at random but avoid walls. The
+    search runs for time_budget seconds per tick it thinks on, or
+    max_rollouts rollouts if that is set, which also makes it play
+    the same rounds the same way. Needs an occupancy grid, plays
+    like AIPlayer without one.
+    """
+    def __init__(self, x, y, color, game_map):
+        super().__init__(x, y, color, game_map)
+
+        self.time_budget = 0.004
+        self.max_rollouts = None
+        # think every few ticks, or when the way ahead is blocked
+        self.think_ticks = 3
+
+        # the tree: how long each move is held, how many moves deep
+        # it goes and how much exploring the UCT formula does
+        self.move_ticks = 8
+        self.max_depth = 4
+        self.exploration = 0.5
+        # a turn has to win this much more than going on straight
+        self.turn_margin = 1.2
+        # how many ticks a rollout plays, and how often the random
+        # players turn without having to
+        self.horizon = 40
+        self.turn_chance = 0.02
+        # rollouts that end this close to the edge of the map count
+        # for less, that part goes when the map shrinks
+        self.edge_margin = 10
+
+        self.arena = RolloutArena()
+        self.rng = random.Random()
+        self.think_counter = 0
+
+        # for rollouts_per_second
+        self.rollouts = 0
+        self.search_time = 0.0
+
+    def reset_round_state(self):
+        super().reset_round_state()
+
+        # the rollouts have their own rng, so they don't change what
+        # happens to the rest of the map
+        self.rng.seed(self.game_map.rng.getrandbits(32))
+        # spread the thinking of the AIs over different ticks
+        self.think_counter = self.trail_id % self.think_ticks
+
+    def save_state(self):
+        return super().save_state() + (self.think_counter, self.rng.getstate())
+
+    def load_state(self, state):
+        super().load_state(state[:-2])
+        self.think_counter = state[-2]
+        self.rng.setstate(state[-1])
+
+    def rollouts_per_second(self):
+        # over all the searches so far
+        if self.search_time == 0:
+            return 0.0
+        return self.rollouts / self.search_time
+
+    def search(self):
+        # returns the direction to go in now, as an index of
+        # ROLLOUT_DIRECTIONS
+        start = time.perf_counter()
+        deadline = start + self.time_budget
+
+        arena = self.arena
+        me = self.trail_id - 1
+        arena.load(self.game_map, me, 2 * self.horizon, self.edge_margin)
+        direction = ROLLOUT_DIRECTIONS.index(self.direction)
+        rng = self.rng
+
+        # a node is [visits, total reward, children or None], the
+        # children are going straight, turning right and turning left
+        root = [0, 0.0, None]
+        plan = []
+        path = []
+        rollouts = 0
+        while True:
+            arena.reset()
+            plan.clear()
+            path.clear()
+
+            node = root
+            path.append(node)
+            d = direction
+            while node[2] is not None and len(plan) < self.max_depth:
+                log_visits = math.log(node[0])
+                best = None
+                best_value = -1.0
+                for a, child in enumerate(node[2]):
+                    if child[0] == 0:
+                        best = a
+                        break
+                    value = child[1] / child[0] + self.exploration * math.sqrt(log_visits / child[0])
+                    if value > best_value:
+                        best = a
+                        best_value = value
+                node = node[2][best]
+                d = (d + (0, 1, 3)[best]) & 3
+                plan.append(d)
+                path.append(node)
+
+            if node[2] is None and len(plan) < self.max_depth and (node is root or node[0] > 0):
+                node[2] = [[0, 0.0, None], [0, 0.0, None], [0, 0.0, None]]
+
+            reward = arena.play(me, plan, self.move_ticks, self.horizon, rng, self.turn_chance)
+            for node in path:
+                node[0] += 1
+                node[1] += reward
+
+            rollouts += 1
+            if self.max_rollouts is not None:
+                if rollouts >= self.max_rollouts:
+                    break
+            elif time.perf_counter() >= deadline:
+                break
+
+        arena.reset()
+        self.rollouts += rollouts
+        self.search_time += time.perf_counter() - start
+
+        # most rollouts end the same whichever way it goes, so keep
+        # going straight unless a turn is clearly better
+        best = 0
+        best_value = -1.0
+        for a, child in enumerate(root[2]):
+            if child[0] == 0:
+                continue
+            value = child[1] / child[0]
+            if a == 0:
+                value *= self.turn_margin
+            if value > best_value:
+                best = a
+                best_value = value
+
+        return (direction + (0, 1, 3)[best]) & 3
+
+    def handle_input(self):
+        if self.game_map.occupancy is None:
+            return super().handle_input()
+
+        self.think_counter += 1
+        ahead = self.get_line_in_direction(self.direction, 1)
+        blocked = self.game_map.occupancy.get(ahead.x2, ahead.y2) != CELL_FREE
+        if not blocked and self.think_counter < self.think_ticks:
+            return None
+        self.think_counter = 0
+
+        direction = ROLLOUT_DIRECTIONS[self.search()]
+        if direction == self.direction:
+            return None
+
+        self.direction = direction
+        self.start_new_line()
+
+
+class TextCache():
+    """
+    Keeps rendered text surfaces around, dropping the least
+    recently used one when there are more than max_size.
+    """
+    def __init__(self, font_object, max_size=64):
+        self.font = font_object
+        self.max_size = max_size
+
+        # (text, color) -> surface, oldest first
+        self.surfaces = collections.OrderedDict()
+
+    def render(self, text, color):
+        # pygame colors cant be dict keys
+        key = (text, tuple(color))
+        surface = self.surfaces.get(key)
+        if surface is None:
+            surface = self.font.render(text, False, color)
+            self.surfaces[key] = surface
+            if len(self.surfaces) > self.max_size:
+                self.surfaces.popitem(last=False)
+        else:
+            self.surfaces.move_to_end(key)
+
+        return surface
+
+
 class TopBar():
     def __init__(self, x, y, w, h, font_object, player_list, game_mode):
         self.x = x
@@ -768,89 +2714,357 @@ class TopBar():
         self.game_mode = game_mode
 
         # the player objects, used for counting the scores
-        self.p1 = player_list[0]
-        self.p2 = player_list[1]
-
-        if self.game_mode in ["1pffa", "2pffa"]:
-            self.p3 = player_list[2]
-            self.p4 = player_list[3]
-            self.p5 = player_list[4]
-            self.p6 = player_list[5]
-
-    def draw(self, screen_surface, seconds_to_shrink):
-        screen_surface.fill(self.black, self.rect)
-
-        pos1 = (self.x, self.y+self.h)
-        pos2 = (self.x+self.w, self.y+self.h)
-        pygame.draw.line(screen_surface, self.white, pos1, pos2, 3)
-
-        text_x = self.x+5
+        self.players = player_list
+
+        self.text_cache = TextCache(self.font)
+
+        # where the labels and scores go, relative to the bar.
+        # a list of (player, label, label position, score position).
+        # when there are more players than places, the places are
+        # (None, None, label position, None) and go to the players
+        # with the best scores, see get_shown_slots.
+        self.score_slots = self.get_score_slots()
+        self.ranked = len(self.score_slots) > 0 and self.score_slots[0][0] is None
+
+        # the bar is put together on its own surface, which is only
+        # done again when what it shows changes. the line at the
+        # bottom reaches 2 pixels below the rect.
+        self.header = None
+        self.surface = None
+        self.shown_state = None
+
+    def get_score_slots(self):
+        text_x = 5 + 10
         text_height = self.font.size("whatever")[1]
 
-        text1 = self.font.render("Cycles", False, self.light_grey)
-        screen_surface.blit(text1, (text_x, self.y))
-
-        text_x += 10
-
         # essentialy drawing the scores where the text is colored
         # the players' colors and the actual numbers are white.
         # it is indeed needlesly complicated, but pygame seems
         # to have no easy way of drawing multi-colored text.
+        slots = []
         if self.game_mode in ["pvp", "pve"]:
-            text2 = self.font.render("P1 score:", False, self.p1.color)
-            screen_surface.blit(text2, (text_x, self.y+text_height*2))
-            score1_x = self.font.size("P1 score:")[0] + text_x
-            score1 = self.font.render(str(self.p1.score), False, self.white)
-            screen_surface.blit(score1, (score1_x, self.y+text_height*2))
-
-            text3 = self.font.render("P2 score:", False, self.p2.color)
-            screen_surface.blit(text3, (text_x, self.y+text_height*3))
-            score2_x = self.font.size("P2 score:")[0] + text_x
-            score2 = self.font.render(str(self.p2.score), False, self.white)
-            screen_surface.blit(score2, (score2_x, self.y+text_height*3))
+            rows = [(2, self.players[0], "P1 score:"), (3, self.players[1], "P2 score:")]
+            for row, p, label in rows:
+                label_pos = (text_x, text_height*row)
+                score_pos = (text_x + self.font.size(label)[0], text_height*row)
+                slots.append((p, label, label_pos, score_pos))
 
         elif self.game_mode in ["1pffa", "2pffa"]:
-            p1_text = self.font.render("P1:", False, self.p1.color)
-            p2_text = self.font.render("P2:", False, self.p2.color)
-            p3_text = self.font.render("P3:", False, self.p3.color)
-            p4_text = self.font.render("P4:", False, self.p4.color)
-            p5_text = self.font.render("P5:", False, self.p5.color)
-            p6_text = self.font.render("P6:", False, self.p6.color)
+            # three in a row, 100 pixels apart. with more players as
+            # many as fit next to each other in two rows, leaving room
+            # for the counter.
+            columns = 3
+            if len(self.players) > 6:
+                columns = max(3, (self.w - 230) // 100)
+
+            places = min(len(self.players), columns * 2)
+            for i in range(places):
+                label_pos = (text_x + (i % columns)*100, 40 + (i // columns)*25)
+                if places < len(self.players):
+                    slots.append((None, None, label_pos, None))
+                else:
+                    p = self.players[i]
+                    label = "P{}:".format(i+1)
+                    slots.append((p, label, label_pos, self.get_score_pos(label, label_pos)))
+
+        return slots
+
+    def get_score_pos(self, label, label_pos):
+        return (label_pos[0] + max(40, self.font.size(label)[0] + 4), label_pos[1])
+
+    def get_shown_slots(self):
+        # the slots with the players in them, when ranked the best
+        # scores first and the earlier seat on a tie.
+        if not self.ranked:
+            return self.score_slots
+
+        order = sorted(range(len(self.players)), key=lambda i: -self.players[i].score)
+        slots = []
+        for i, slot in zip(order, self.score_slots):
+            label_pos = slot[2]
+            label = "P{}:".format(i+1)
+            slots.append((self.players[i], label, label_pos, self.get_score_pos(label, label_pos)))
+
+        return slots
+
+    def make_header(self):
+        # everything that never changes
+        header = pygame.Surface((self.w, self.h+2))
+        header.fill(self.black)
+
+        pygame.draw.line(header, self.white, (0, self.h), (self.w, self.h), 3)
+
+        text1 = self.text_cache.render("Cycles", self.light_grey)
+        header.blit(text1, (5, 0))
+
+        if not self.ranked:
+            for p, label, label_pos, score_pos in self.score_slots:
+                header.blit(self.text_cache.render(label, p.color), label_pos)
+
+        return header
+
+    def compose(self, seconds_to_shrink):
+        if self.header is None:
+            self.header = self.make_header()
+        if self.surface is None:
+            self.surface = self.header.copy()
+        else:
+            self.surface.blit(self.header, (0, 0))
 
-            p1_score = self.font.render(str(self.p1.score), False, self.white)
-            p2_score = self.font.render(str(self.p2.score), False, self.white)
-            p3_score = self.font.render(str(self.p3.score), False, self.white)
-            p4_score = self.font.render(str(self.p4.score), False, self.white)
-            p5_score = self.font.render(str(self.p5.score), False, self.white)
-            p6_score = self.font.render(str(self.p6.score), False, self.white)
+        for p, label, label_pos, score_pos in self.get_shown_slots():
+            if self.ranked:
+                self.surface.blit(self.text_cache.render(label, p.color), label_pos)
+            score = self.text_cache.render(str(p.score), self.white)
+            self.surface.blit(score, score_pos)
 
-            # p1
-            screen_surface.blit(p1_text, (text_x, self.y+40))
-            screen_surface.blit(p1_score, (text_x+40, self.y+40))
+        # show how many seconds to map reduction
+        counter_pos = (self.w - 200, self.h - 30)
+        counter_text = self.text_cache.render("Reducing in: {}".format(seconds_to_shrink), self.white)
+        self.surface.blit(counter_text, counter_pos)
 
-            # p2
-            screen_surface.blit(p2_text, (text_x+100, self.y+40))
-            screen_surface.blit(p2_score, (text_x+100+40, self.y+40))
+    def draw(self, screen_surface, seconds_to_shrink):
+        # returns a list of the rects that look different
+        # on the screen now.
+        state = ([p.score for p in self.players], seconds_to_shrink)
 
-            # and so on
-            screen_surface.blit(p3_text, (text_x+200, self.y+40))
-            screen_surface.blit(p3_score, (text_x+200+40, self.y+40))
+        dirty_rects = []
+        if state != self.shown_state:
+            self.compose(seconds_to_shrink)
+            self.shown_state = state
+            dirty_rects.append(self.surface.get_rect(topleft=(self.x, self.y)))
 
-            screen_surface.blit(p4_text, (text_x, self.y+65))
-            screen_surface.blit(p4_score, (text_x+40, self.y+65))
+        # always put it back, the map may have drawn over the line
+        screen_surface.blit(self.surface, (self.x, self.y))
 
-            screen_surface.blit(p5_text, (text_x+100, self.y+65))
-            screen_surface.blit(p5_score, (text_x+100+40, self.y+65))
+        return dirty_rects
 
-            screen_surface.blit(p6_text, (text_x+200, self.y+65))
-            screen_surface.blit(p6_score, (text_x+200+40, self.y+65))
 
-        # show how many seconds to map reduction
-        counter_x = self.x + self.w - 200
-        counter_y = self.y + self.h - 30
-        counter_text = self.font.render("Reducing in: {}".format(seconds_to_shrink), False, self.white)
-        screen_surface.blit(counter_text, (counter_x, counter_y))
+class Minimap():
+    """
+    A small picture of the whole map for the top bar, made straight
+    from the occupancy grid, so it costs the same however many lines
+    there are. It is only made again every refresh_frames frames.
+    Needs numpy and a map with an occupancy grid, draws nothing
+    otherwise.
+    """
+    def __init__(self, x, y, w, h, refresh_frames=15):
+        # the most room it can take, the map keeps its shape in it
+        self.x = x
+        self.y = y
+        self.w = w
+        self.h = h
+        self.refresh_frames = refresh_frames
 
+        self.white = pygame.Color(255, 255, 255)
+        self.black = pygame.Color(0, 0, 0)
+
+        self.game_map = None
+        # cell value -> color, as a numpy array of rgb rows
+        self.palette = None
+        # how many grid cells go into one minimap pixel
+        self.block = 1
+        self.surface = None
+        self.frames = 0
+
+    def set_map(self, game_map):
+        self.game_map = game_map
+        self.surface = None
+        self.frames = 0
+
+        grid = game_map.occupancy
+        if numpy is None or grid is None:
+            return
+
+        palette = numpy.zeros((256, 3), dtype=numpy.uint8)
+        palette[CELL_FREE] = tuple(game_map.field_bkg)[:3]
+        palette[CELL_OBSTACLE] = tuple(game_map.full_bkg)[:3]
+        palette[CELL_BORDER] = tuple(game_map.full_bkg)[:3]
+        for p in game_map.players:
+            palette[p.trail_id] = tuple(p.color)[:3]
+        self.palette = palette
+
+        self.block = max(math.ceil(grid.w / self.w), math.ceil(grid.h / self.h), 1)
+        self.surface = pygame.Surface((grid.w // self.block, grid.h // self.block))
+
+    def refresh(self, camera=None):
+        grid = self.game_map.occupancy
+        b = self.block
+        sw, sh = self.surface.get_size()
+
+        # every pixel is the highest cell value of its block, so one
+        # pixel wide trails don't get lost. the edges that don't make
+        # up a whole block are left out.
+        # rows first, while they are still one piece of memory
+        cells = numpy.frombuffer(grid.cells, dtype=numpy.uint8, count=sh*b*grid.w)
+        cells = cells.reshape(sh, b, grid.w).max(axis=1)
+        cells = cells[:, :sw*b].reshape(sh, sw, b).max(axis=2)
+        pygame.surfarray.blit_array(self.surface, self.palette[cells].transpose(1, 0, 2))
+
+        for p in self.game_map.players:
+            self.surface.fill(p.color, ((p.x - grid.x) // b - 1, (p.y - grid.y) // b - 1, 3, 3))
+
+        if camera is not None and camera.target is not None:
+            x1, y1, x2, y2 = camera.get_view_bounds()
+            view = pygame.Rect((x1 - grid.x) // b, (y1 - grid.y) // b, (x2 - x1) // b + 1, (y2 - y1) // b + 1)
+            pygame.draw.rect(self.surface, self.white, view, 1)
+
+    def draw(self, screen_surface, game_map, camera=None):
+        # has to be drawn after the top bar every frame, returns the
+        # rect that changed when it was made again.
+        if game_map is not self.game_map:
+            self.set_map(game_map)
+        if self.surface is None:
+            return []
+
+        dirty_rects = []
+        if self.frames % self.refresh_frames == 0:
+            self.refresh(camera)
+            dirty_rects.append(self.surface.get_rect(topleft=(self.x, self.y)))
+        self.frames += 1
+
+        screen_surface.blit(self.surface, (self.x, self.y))
+        return dirty_rects
+
+
+class FrameTimer():
+    """
+    Times the phases of every frame of play_game. Each call to mark
+    ends the phase that started at the previous one, so timing a
+    frame costs one clock read per phase.
+
+    The last window frames are kept for the percentiles on the
+    overlay, and the last trace_size phases as a trace that can be
+    saved for chrome://tracing or ui.perfetto.dev.
+    """
+    # in the order they happen during a frame
+    PHASES = ["events", "shrink", "input", "ai", "update", "map", "topbar", "overlay", "display", "wait"]
+
+    def __init__(self, window=300, trace_size=100000):
+        self.window = window
+
+        # phase -> the last window frames' times in seconds,
+        # "frame" is the whole frame.
+        self.history = {}
+        for phase in self.PHASES + ["frame"]:
+            self.history[phase] = collections.deque(maxlen=window)
+
+        # (phase, start, duration, frame, tick, player index) with
+        # the times in seconds since the timer was made
+        self.trace = collections.deque(maxlen=trace_size)
+
+        self.origin = time.perf_counter()
+        self.frames = 0
+        self.tick = 0
+        self.frame_start = self.origin
+        self.last = self.origin
+        # phase -> seconds spent on it in the current frame
+        self.totals = dict.fromkeys(self.PHASES, 0.0)
+
+    def start_frame(self, tick):
+        # also throws away whatever was marked since the last
+        # end_frame, like the time spent in a pause
+        self.tick = tick
+        self.frame_start = time.perf_counter()
+        self.last = self.frame_start
+        for phase in self.totals:
+            self.totals[phase] = 0.0
+
+    def mark(self, phase, player_index=None):
+        now = time.perf_counter()
+        duration = now - self.last
+        self.totals[phase] += duration
+        self.trace.append((phase, self.last - self.origin, duration, self.frames, self.tick, player_index))
+        self.last = now
+
+    def end_frame(self):
+        for phase, duration in self.totals.items():
+            self.history[phase].append(duration)
+
+        duration = self.last - self.frame_start
+        self.history["frame"].append(duration)
+        self.trace.append(("frame", self.frame_start - self.origin, duration, self.frames, self.tick, None))
+        self.frames += 1
+
+    def percentiles(self, phase):
+        # (p50, p99) of the phase over the last frames, in seconds
+        times = sorted(self.history[phase])
+        if len(times) == 0:
+            return (0.0, 0.0)
+
+        p50 = times[(len(times) - 1) * 50 // 100]
+        p99 = times[(len(times) - 1) * 99 // 100]
+        return (p50, p99)
+
+    def get_trace_events(self):
+        # the trace in the chrome trace event format, complete
+        # events with the times in microseconds
+        events = []
+        for phase, start, duration, frame, tick, player_index in self.trace:
+            args = {"frame": frame, "tick": tick}
+            if player_index is not None:
+                args["player"] = player_index
+            events.append({"name": phase, "cat": "frame" if phase == "frame" else "phase",
+                           "ph": "X", "ts": start * 1e6, "dur": duration * 1e6,
+                           "pid": 1, "tid": 1, "args": args})
+
+        return events
+
+    def save_trace(self, path):
+        with open(path, "w") as f:
+            json.dump({"traceEvents": self.get_trace_events(), "displayTimeUnit": "ms"}, f)
+
+
+class TimingOverlay():
+    """
+    Shows the p50 and p99 of every phase of a FrameTimer over the
+    map. The text is only rendered again every refresh_frames frames.
+    """
+    def __init__(self, x, y, font_object, timer, refresh_frames=30):
+        self.x = x
+        self.y = y
+        self.font = font_object
+        self.timer = timer
+        self.refresh_frames = refresh_frames
+
+        self.white = pygame.Color(255, 255, 255)
+        self.background = pygame.Color(0, 0, 0)
+
+        self.visible = False
+        self.surface = None
+        self.shown_frame = None
+
+    def toggle(self):
+        self.visible = not self.visible
+        self.shown_frame = None
+
+    def compose(self):
+        lines = ["{:<8}{:>7}{:>7}".format("ms", "p50", "p99")]
+        for phase in self.timer.PHASES + ["frame"]:
+            p50, p99 = self.timer.percentiles(phase)
+            lines.append("{:<8}{:>7.2f}{:>7.2f}".format(phase, p50 * 1000, p99 * 1000))
+
+        line_height = self.font.get_linesize()
+        width = max(self.font.size(line)[0] for line in lines)
+        self.surface = pygame.Surface((width + 10, line_height * len(lines) + 10))
+        self.surface.fill(self.background)
+        self.surface.set_alpha(200)
+        for i, line in enumerate(lines):
+            self.surface.blit(self.font.render(line, False, self.white), (5, 5 + i * line_height))
+
+    def draw(self, screen_surface, game_map):
+        # drawn over the map every frame, the map puts back what
+        # was under it on the next draw.
+        if not self.visible:
+            return []
+
+        frames = self.timer.frames
+        if self.shown_frame is None or frames - self.shown_frame >= self.refresh_frames:
+            self.compose()
+            self.shown_frame = frames
+
+        rect = screen_surface.blit(self.surface, (self.x, self.y))
+        game_map.redraw_area(rect)
+        return [rect]
 
 
 def main_menu(scr_size, scr_surface, font):
@@ -1047,87 +3261,99 @@ def end_game_dialog(screen_surface, font, screen_size):
     return response
 
 
-def start_level(player_list):
+# the map goes under the top bar
+MAP_X = 0
+MAP_Y = 100
+MAP_SIZE = (800, 500)
+
+# obstacles per 100x100 pixels, 10 on the usual map
+OBSTACLE_DENSITY = 0.25
+
+# where the players start on the usual map, as (x, y, direction)
+# relative to its top left corner
+CLASSIC_SPAWNS = {2: [(150, 250, "up"), (650, 250, "up")],
+                  6: [(100, 150, "up"), (400, 150, "up"), (700, 150, "up"),
+                      (100, 350, "down"), (400, 350, "down"), (700, 350, "down")]}
+
+
+def get_spawn_points(count, x, y, w, h):
+    # (x, y, direction) for count players on the map x, y, w, h.
+    # they are spread over rows of about square cells, the upper
+    # half of the rows start going up and the rest down.
+    if (w, h) == MAP_SIZE and count in CLASSIC_SPAWNS:
+        return [(x + sx, y + sy, d) for sx, sy, d in CLASSIC_SPAWNS[count]]
+
+    columns = min(max(round(math.sqrt(count * w / h)), 1), count)
+    rows = math.ceil(count / columns)
+
+    spawns = []
+    for row in range(rows):
+        # the last row can have fewer, spread out over the width
+        in_row = min(columns, count - row * columns)
+        direction = "up" if row < rows / 2 else "down"
+        for column in range(in_row):
+            spawns.append((x + w * (2*column + 1) // (2*in_row),
+                           y + h * (2*row + 1) // (2*rows),
+                           direction))
+
+    return spawns
+
+
+def start_level(player_list, occupancy=True, free_run=True, seed=None, map_size=MAP_SIZE, obstacle_density=OBSTACLE_DENSITY):
     """
-    map_size -> tuple(w, h)
+    occupancy -> use an OccupancyGrid for collision checks
+    free_run -> also keep FreeRunTables for the AI, needs occupancy
+    seed -> decides the whole round, a random one if None
+    map_size -> (width, height) of the map
+    obstacle_density -> how many obstacles per 100x100 pixels
     """
     # start a game level, do all the needed preparations
     # return a GameMap object
 
+    if seed is None:
+        seed = random.getrandbits(32)
+
+    if len(player_list) < 1 or len(player_list) >= CELL_OBSTACLE:
+        raise Exception("unsupported number of players")
+
+    w, h = map_size
+    spawns = get_spawn_points(len(player_list), MAP_X, MAP_Y, w, h)
+
     # first reset the stuff that may be left over from the previous
     # match.
-    if len(player_list) == 2:
-        p1 = player_list[0]
-        p2 = player_list[1]
-
-        p1.lines.clear()
-        p2.lines.clear()
-        p1.direction = "up"
-        p2.direction = "up"
-        p1.x = 150
-        p1.y = 350
-        p2.x = 650
-        p2.y = 350
-
-        game_map = GameMap(0, 100, 800, 500)
-        game_map.fill_with_obstacles(10)
-        game_map.players.append(p1)
-        game_map.players.append(p2)
-
-        p1.game_map = game_map
-        p2.game_map = game_map
-
-    elif len(player_list) == 6:
-        p1 = player_list[0]
-        p2 = player_list[1]
-        p3 = player_list[2]
-        p4 = player_list[3]
-        p5 = player_list[4]
-        p6 = player_list[5]
-
-        p1.direction = "up"
-        p2.direction = "up"
-        p3.direction = "up"
-        p4.direction = "down"
-        p5.direction = "down"
-        p6.direction = "down"
-        for p in player_list:
-            p.lines.clear()
-
-        # top row
-        p1.x = 100
-        p1.y = 250
-        p2.x = 400
-        p2.y = 250
-        p3.x = 700
-        p3.y = 250
-
-        # bottom row
-        p4.x = 100
-        p4.y = 450
-        p5.x = 400
-        p5.y = 450
-        p6.x = 700
-        p6.y = 450
-
-        game_map = GameMap(0, 100, 800, 500)
-        game_map.fill_with_obstacles(10)
-        for p in player_list:
-            game_map.players.append(p)
-            p.game_map = game_map
+    for p, (x, y, direction) in zip(player_list, spawns):
+        p.trail.clear()
+        p.x = x
+        p.y = y
+        p.direction = direction
 
-    else:
-        raise Exception("unsupported number of players")
+    game_map = GameMap(MAP_X, MAP_Y, w, h, seed)
+    game_map.fill_with_obstacles(round(obstacle_density * w * h / 10000), [(x, y) for x, y, d in spawns])
+    for p in player_list:
+        game_map.add_player(p)
+
+    if occupancy:
+        game_map.enable_occupancy(free_run)
 
     return game_map
 
 
-def play_game(scr_size, scr_surface, font, game_mode):
-    global all_events
+def get_player_color(i):
+    # colors for the players after the first six, going around the
+    # hues so that neighbours look different
+    color = pygame.color.Color(0, 0, 0)
+    color.hsva = ((i * 137.5) % 360, 70, 100, 100)
+    return color
 
-    screen_size = scr_size
-    screen_surface = scr_surface
 
+def create_players(game_mode, human_seats=True, player_count=None):
+    """
+    human_seats -> if False, AI players take the seats of the humans
+    player_count -> for the ffa modes, how many players in total
+    """
+    # create the players for a game mode, in drawing and scoring order.
+    # game_map arg can be None since that will be handled
+    # in start_level.
     blue = pygame.color.Color(41, 143, 255)
     red = pygame.color.Color(204, 0, 0)
 
@@ -1136,28 +3362,23 @@ def play_game(scr_size, scr_surface, font, game_mode):
     magenta = pygame.color.Color(255, 0, 255)
     white = pygame.color.Color(255, 255, 255)
 
-    fps_rate = 60
-    # shrink every 20 seconds
-    shrink_rate = fps_rate * 20
-    shrink_size = 20
+    def human(color, input_dict):
+        if not human_seats:
+            return AIPlayer(0, 0, color, None)
+        p = Player(0, 0, color, None)
+        p.input_dict = input_dict
+        return p
 
-    # game_map arg can be None since that will be handled
-    # in start_level.
-    all_players = []
     if game_mode == "pvp":
-        p1 = Player(0, 0, blue, None)
-        p1.input_dict = p1_input
-        p2 = Player(0, 0, red, None)
-        p2.input_dict = p2_input
+        p1 = human(blue, p1_input)
+        p2 = human(red, p2_input)
         all_players = [p1, p2]
     elif game_mode == "pve":
-        p1 = Player(0, 0, blue, None)
-        p1.input_dict = p1_input
+        p1 = human(blue, p1_input)
         p2 = AIPlayer(0, 0, red, None)
         all_players = [p1, p2]
     elif game_mode == "1pffa":
-        p1 = Player(0, 0, blue, None)
-        p1.input_dict = p1_input
+        p1 = human(blue, p1_input)
         p2 = AIPlayer(0, 0, red, None)
         p3 = AIPlayer(0, 0, green, None)
         p4 = AIPlayer(0, 0, yellow, None)
@@ -1165,10 +3386,8 @@ def play_game(scr_size, scr_surface, font, game_mode):
         p6 = AIPlayer(0, 0, white, None)
         all_players = [p1, p2, p3, p4, p5, p6]
     elif game_mode == "2pffa":
-        p1 = Player(0, 0, blue, None)
-        p1.input_dict = p1_input
-        p2 = Player(0, 0, red, None)
-        p2.input_dict = p2_input
+        p1 = human(blue, p1_input)
+        p2 = human(red, p2_input)
         p3 = AIPlayer(0, 0, green, None)
         p4 = AIPlayer(0, 0, yellow, None)
         p5 = AIPlayer(0, 0, magenta, None)
@@ -1177,73 +3396,380 @@ def play_game(scr_size, scr_surface, font, game_mode):
     else:
         raise Exception("unsupported gamemode")
 
-    clock = pygame.time.Clock()
+    if player_count is not None and game_mode in ["1pffa", "2pffa"]:
+        humans = 1 if game_mode == "1pffa" else 2
+        if player_count < humans + 1:
+            raise Exception("not enough players for " + game_mode)
+
+        # the humans keep their seats, AI players come and go
+        all_players = all_players[:player_count]
+        for i in range(len(all_players), player_count):
+            all_players.append(AIPlayer(0, 0, get_player_color(i), None))
+
+    return all_players
+
+
+class Snapshot():
+    # a moment of a round, see Simulation.snapshot
+    def __init__(self):
+        self.ticks = 0
+        self.shrink_counter = 0
+        self.round_over = False
+        self.winner = None
+        self.turn_count = 0
+        self.crashed_players = []
+        self.crash_ticks = {}
+
+        # the map rect, the index of the obstacles that can still be
+        # hit, what the occupancy grid has inside the border and the
+        # map's rng
+        self.map_rect = (0, 0, 0, 0)
+        self.obstacle_index = None
+        self.grid_inside = None
+        self.rng_state = None
+        # lengths of the map's undo logs
+        self.undo_marks = ()
+
+        # Player.save_state of every player
+        self.players = []
+
+
+class Simulation():
+    """
+    Runs rounds as fast as possible, with no window, event queue
+    or frame limiting. Drawing and keyboard input are attached
+    from the outside, see play_game.
+    """
+    def __init__(self, player_list, tick_rate=60, shrink_seconds=20, shrink_size=20, occupancy=True, free_run=True,
+                 map_size=MAP_SIZE, obstacle_density=OBSTACLE_DENSITY):
+        self.players = player_list
+        self.occupancy = occupancy
+        self.free_run = free_run
+
+        # for the maps of new rounds, see start_level
+        self.map_size = map_size
+        self.obstacle_density = obstacle_density
+
+        # the map shrinks every shrink_rate ticks
+        self.tick_rate = tick_rate
+        self.shrink_seconds = shrink_seconds
+        self.shrink_rate = tick_rate * shrink_seconds
+        self.shrink_size = shrink_size
+
+        # these are reset by start_round
+        self.game_map = None
+        self.shrink_counter = self.shrink_rate
+        self.crashed_players = []
+        # player -> how many ticks it lasted before crashing
+        self.crash_ticks = {}
+
+        # how the round started and every (tick, player index,
+        # direction) a player started a new line on, which is all
+        # it takes to play the round again.
+        self.start_positions = []
+        self.turns = []
+        self.ticks = 0
+        self.round_over = False
+        self.winner = None
+
+        # a FrameTimer to mark the phases of every step on, if any
+        self.timer = None
+
+        # the Snapshots that can be restored, oldest first
+        self.snapshots = []
+
+    def start_round(self, seed=None, game_map=None):
+        # game_map can be a map that is already set up with the
+        # players, otherwise a new level is started.
+        if game_map is None:
+            game_map = start_level(self.players, self.occupancy, self.free_run, seed,
+                                   self.map_size, self.obstacle_density)
+        self.game_map = game_map
+
+        # this will keep track of when the map gets reduced
+        self.shrink_counter = self.shrink_rate
+        self.crashed_players = []
+        self.crash_ticks = {}
+        self.start_positions = [(p.x, p.y, p.direction) for p in self.players]
+        self.turns = []
+        self.ticks = 0
+        self.round_over = False
+        self.winner = None
+        self.snapshots = []
+
+        return self.game_map
+
+    def alive_players(self):
+        return [p for p in self.players if not p in self.crashed_players]
+
+    def snapshot(self):
+        # save the round as it is now, restore goes back to it. from
+        # the first snapshot on, the map logs every change to its
+        # collision data, so taking and restoring a snapshot costs
+        # about as much as what changed since, not the whole round.
+        game_map = self.game_map
+        if len(self.snapshots) == 0:
+            game_map.keep_undo_log(True)
+
+        s = Snapshot()
+        s.ticks = self.ticks
+        s.shrink_counter = self.shrink_counter
+        s.round_over = self.round_over
+        s.winner = self.winner
+        s.turn_count = len(self.turns)
+        s.crashed_players = list(self.crashed_players)
+        s.crash_ticks = dict(self.crash_ticks)
+
+        s.map_rect = (game_map.x, game_map.y, game_map.width, game_map.height)
+        s.obstacle_index = game_map.obstacle_index
+        if game_map.occupancy is not None:
+            s.grid_inside = game_map.occupancy.inside
+        s.rng_state = game_map.rng.getstate()
+        s.undo_marks = game_map.get_undo_marks()
+
+        s.players = [p.save_state() for p in self.players]
+
+        self.snapshots.append(s)
+        return s
+
+    def restore(self, snapshot):
+        # go back to a snapshot of this round. it can be restored again
+        # later, but the ones taken after it can't.
+        for i, s in enumerate(self.snapshots):
+            if s is snapshot:
+                break
+        else:
+            raise Exception("snapshot is not from this round or was dropped")
+        del self.snapshots[i+1:]
+
+        self.ticks = snapshot.ticks
+        self.shrink_counter = snapshot.shrink_counter
+        self.round_over = snapshot.round_over
+        self.winner = snapshot.winner
+        del self.turns[snapshot.turn_count:]
+        self.crashed_players = list(snapshot.crashed_players)
+        self.crash_ticks = dict(snapshot.crash_ticks)
+
+        game_map = self.game_map
+        game_map.undo(snapshot.undo_marks)
+        game_map.x, game_map.y, game_map.width, game_map.height = snapshot.map_rect
+        game_map.rect = pygame.Rect(snapshot.map_rect)
+        if game_map.obstacle_index is not snapshot.obstacle_index:
+            game_map.obstacle_index = snapshot.obstacle_index
+            game_map.obstacle_table = None
+        if game_map.occupancy is not None:
+            game_map.occupancy.inside = snapshot.grid_inside
+        game_map.rng.setstate(snapshot.rng_state)
+
+        for p, state in zip(self.players, snapshot.players):
+            p.load_state(state)
+            p.crashed = p in self.crashed_players
+
+    def drop_snapshots(self):
+        # forget all the snapshots and stop logging changes
+        self.snapshots = []
+        self.game_map.keep_undo_log(False)
+
+    def seconds_to_shrink(self):
+        return int(self.shrink_counter / self.tick_rate)
+
+    def step(self):
+        # advance the round by one tick, returns True when it is over
+
+        # the countdown of the previous tick is finished here instead
+        # of at the end of it, so anything drawn between two steps sees
+        # the same map and counter the tick was played on.
+        timer = self.timer
+
+        if self.ticks > 0:
+            self.shrink_counter -= 1
+            if self.shrink_counter == 0:
+                self.shrink_counter = self.shrink_rate
+                self.game_map.shrink(self.shrink_size)
+                if timer is not None:
+                    timer.mark("shrink")
+
+        for i, p in enumerate(self.players):
+            if not p in self.crashed_players:
+                line_count = len(p.trail)
+                p.handle_input()
+                if len(p.trail) != line_count:
+                    self.turns.append((self.ticks, i, p.direction))
+                if timer is not None:
+                    timer.mark("ai" if isinstance(p, AIPlayer) else "input", i)
+
+        for i, p in enumerate(self.players):
+            if not p in self.crashed_players:
+                status = p.update()
+                if status == "crashed":
+                    self.crashed_players.append(p)
+                    self.crash_ticks[p] = self.ticks
+                if timer is not None:
+                    timer.mark("update", i)
+
+        self.ticks += 1
+
+        # the last one standing scores. if everyone left crashed on
+        # the same tick, nobody does.
+        alive = self.alive_players()
+        if len(alive) <= 1:
+            self.round_over = True
+            if len(alive) == 1:
+                self.winner = alive[0]
+                self.winner.score += 1
+
+        return self.round_over
+
+    def run_round(self, seed=None):
+        # play a whole round, returns the winner (or None)
+        self.start_round(seed)
+        while not self.step():
+            pass
+
+        return self.winner
+
+
+def play_game(scr_size, scr_surface, font, game_mode, max_frame_skip=5, player_count=None, map_size=MAP_SIZE):
+    """
+    max_frame_skip -> how many frames in a row may go undrawn to keep
+    the game running at full speed when drawing can't keep up
+    player_count, map_size -> see create_players and start_level
+    """
+    global all_events
+
+    screen_size = scr_size
+    screen_surface = scr_surface
+
+    # the game always runs at this many ticks per second, however
+    # fast the frames get drawn
+    tick_rate = 60
+    tick_time = 1 / tick_rate
+
+    all_players = create_players(game_mode, player_count=player_count)
+    simulation = Simulation(all_players, tick_rate, map_size=map_size)
 
     font1 = font
     bar1 = TopBar(0, 0, 800, 100, font1, all_players, game_mode)
 
+    # F3 shows how long each part of a frame takes, F4 saves the
+    # recent frames as a trace
+    timer = FrameTimer()
+    simulation.timer = timer
+    overlay_font = pygame.font.Font("DejaVuSansMono.ttf", 12)
+    overlay = TimingOverlay(5, 105, overlay_font, timer)
+
+    # maps that dont fit under the top bar (python cycles.py
+    # --map-size 2000x2000) are shown through a camera, that
+    # follows the first human player. tab goes to the
+    # next player or the whole map, + and - zoom.
+    view_rect = pygame.Rect(0, 100, screen_size[0], screen_size[1] - 100)
+    camera = Camera(*view_rect)
+    # those maps also get a minimap in the top bar, between the
+    # scores and the counter
+    minimap = Minimap(bar1.w - 310, 5, 100, 90)
+    for p in all_players:
+        if p.input_dict is not None:
+            camera.target = p
+            break
+
     all_matches_finished = False
     while not all_matches_finished:
 
-        game_map = start_level(all_players)
+        game_map = simulation.start_round()
+        use_camera = not view_rect.contains(game_map.orig_rect)
 
-        # this will keep track of when the map gets reduced
-        to_shrink = shrink_rate
-        shrink_counter = shrink_rate
+        # how much game time is owed, the ticks are played in steps
+        # of tick_time whenever there is enough of it
+        lag = 0.0
+        previous = time.perf_counter()
+        all_events = []
 
         game_running = True
-
-        crashed_players = []
         while game_running:
-            all_events = pygame.event.get()
+            timer.start_frame(simulation.ticks)
+            events = pygame.event.get()
 
-            for e in all_events:
+            paused = False
+            for e in events:
                 if e.type == pygame.KEYDOWN:
                     if e.key == pygame.K_ESCAPE:
                         game_running = False
                     elif e.key == pygame.K_p:
                         pause_game(screen_surface, font1, screen_size)
-
-            for p in all_players:
-                if not p in crashed_players:
-                    p.handle_input()
-
-            status = ""
-            for p in all_players:
-                if not p in crashed_players:
-                    status = p.update()
-                    if status == "crashed":
-                        crashed_players.append(p)
-
-            if len(crashed_players) == len(all_players)-1:
-                uncrashed_player = None
-                for p in all_players:
-                    if not p in crashed_players:
-                        uncrashed_player = p
-
-                uncrashed_player.score += 1
+                        game_map.full_redraw = True
+                        paused = True
+                    elif e.key == pygame.K_F3:
+                        overlay.toggle()
+                    elif e.key == pygame.K_F4:
+                        timer.save_trace(time.strftime("cycles-trace-%Y%m%d-%H%M%S.json"))
+                    elif e.key == pygame.K_TAB:
+                        camera.follow_next(simulation.alive_players())
+                    elif e.key in (pygame.K_PLUS, pygame.K_EQUALS, pygame.K_KP_PLUS):
+                        camera.change_zoom(2)
+                    elif e.key in (pygame.K_MINUS, pygame.K_KP_MINUS):
+                        camera.change_zoom(0.5)
+
+            # the events stay around until a tick gets to see them
+            all_events.extend(events)
+
+            # the pause is not part of the frame, nor owed game time
+            if paused:
+                timer.start_frame(simulation.ticks)
+                previous = time.perf_counter()
+            timer.mark("events")
+
+            now = time.perf_counter()
+            lag += now - previous
+            previous = now
+
+            # if even skipping frames can't catch up, the game slows
+            # down instead of trying to play a pile of ticks at once
+            lag = min(lag, tick_time * (max_frame_skip + 1))
+
+            steps = 0
+            while lag >= tick_time and not simulation.round_over:
+                simulation.step()
+                lag -= tick_time
+                steps += 1
+                # only the first tick sees the key presses
+                all_events = []
+
+            if simulation.round_over:
                 game_running = False
 
-            # just for debugging
-            #lines = []
-            #for p in game_map.players:
-            #    lines.extend(p.lines)
-            #print(len(lines))
+            # nothing to draw if no tick was played
+            if steps > 0:
+                # draw everything here, only the changed parts of
+                # the screen get updated.
+                if use_camera:
+                    dirty_rects = game_map.draw_view(screen_surface, camera)
+                else:
+                    dirty_rects = game_map.draw(screen_surface)
+                timer.mark("map")
 
-            # draw everything here
-            game_map.draw(screen_surface)
+                seconds_to_shrink = simulation.seconds_to_shrink()
+                dirty_rects.extend(bar1.draw(screen_surface, seconds_to_shrink))
+                if use_camera:
+                    dirty_rects.extend(minimap.draw(screen_surface, game_map, camera))
+                timer.mark("topbar")
 
-            seconds_to_shrink = int(shrink_counter / fps_rate)
-            bar1.draw(screen_surface, seconds_to_shrink)
+                dirty_rects.extend(overlay.draw(screen_surface, game_map))
+                timer.mark("overlay")
 
-            pygame.display.flip()
+                pygame.display.update(dirty_rects)
+                timer.mark("display")
 
-            clock.tick(fps_rate)
+            # sleep until the next tick is due, rounding up so there
+            # is no spinning on the last fraction of a millisecond
+            wait = tick_time - lag - (time.perf_counter() - previous)
+            if wait > 0:
+                pygame.time.wait(math.ceil(wait * 1000))
+            timer.mark("wait")
 
-            shrink_counter -= 1
-            if shrink_counter == 0:
-                shrink_counter = shrink_rate
-                game_map.shrink(shrink_size)
+            if steps > 0:
+                timer.end_frame()
+
+        all_events = []
 
         choice = end_game_dialog(screen_surface, font1, screen_size)
         if choice == "finish":
@@ -1251,6 +3777,23 @@ def play_game(scr_size, scr_surface, font, game_mode):
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Play cycles.")
+    parser.add_argument("--map-size", default=None, metavar="WxH",
+                        help="size of the map, 800x500 by default. bigger maps are shown through a camera")
+    parser.add_argument("--players", type=int, default=None,
+                        help="how many players in the ffa modes, 6 by default")
+    args = parser.parse_args()
+
+    map_size = MAP_SIZE
+    if args.map_size is not None:
+        try:
+            w, h = args.map_size.lower().split("x")
+            map_size = (int(w), int(h))
+        except ValueError:
+            parser.error("map size should look like 2000x2000")
+    if args.players is not None and not 3 <= args.players < CELL_OBSTACLE:
+        parser.error("the ffa modes need 3 to {} players".format(CELL_OBSTACLE - 1))
+
     scr_size = (800, 600)
     scr_surface = initialize(*scr_size)
 
@@ -1261,7 +3804,7 @@ def main():
         menu_choice = main_menu(scr_size, scr_surface, font1)
         if menu_choice == "start":
             game_mode = game_types_menu(scr_size, scr_surface, font1)
-            play_game(scr_size, scr_surface, font1, game_mode)
+            play_game(scr_size, scr_surface, font1, game_mode, player_count=args.players, map_size=map_size)
         elif menu_choice == "about":
             show_about_screen(scr_size, scr_surface)
         elif menu_choice == "exit":
@@ -0,0 +1,241 @@
+"""
+Compact binary replays of single rounds.
+
+A replay holds the seed, the map, where the players started, the
+obstacles and every time a player started a new line. Playing it
+back runs the same rules with players that just follow the recorded
+turns, so the trails come out the same without running any AI.
+
+    r = replay.record(simulation)
+    r.save("round.cyr")
+    simulation = replay.load("round.cyr").play()
+"""
+
+import os
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+import struct
+
+import pygame
+
+import cycles
+
+
+MAGIC = b"CYRP"
+VERSION = 1
+
+# directions are stored as their index in here
+DIRECTIONS = ["up", "down", "left", "right"]
+
+# magic, version, seed, tick rate, shrink seconds, shrink size,
+# map x, y, w, h, ticks played, winner (NO_WINNER if none), player count
+HEADER = struct.Struct("<4sBQHHHiiiiIHB")
+NO_WINNER = 0xffff
+# x, y, direction, color
+PLAYER = struct.Struct("<iiBBBB")
+# x, y, w, h
+OBSTACLE = struct.Struct("<iiii")
+COUNT = struct.Struct("<I")
+
+
+def write_varint(out, value):
+    # 7 bits at a time, the high bit says more follow
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def read_varint(data, pos):
+    # returns (value, new pos)
+    value = 0
+    shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        value |= (b & 0x7f) << shift
+        if b < 0x80:
+            return value, pos
+        shift += 7
+
+
+class Replay():
+    def __init__(self):
+        self.seed = 0
+        self.tick_rate = 60
+        self.shrink_seconds = 20
+        self.shrink_size = 20
+
+        # the original map rect, x, y, w, h
+        self.map_rect = (0, 0, 0, 0)
+
+        # how the round ended
+        self.ticks = 0
+        self.winner = None
+
+        # (x, y, direction, (r, g, b)) per player
+        self.players = []
+        # (x, y, w, h) per obstacle
+        self.obstacles = []
+        # (tick, player index, direction), in order
+        self.turns = []
+
+    def to_bytes(self):
+        out = bytearray()
+
+        winner = NO_WINNER
+        if self.winner is not None:
+            winner = self.winner
+        out += HEADER.pack(MAGIC, VERSION, self.seed, self.tick_rate,
+                           self.shrink_seconds, self.shrink_size,
+                           *self.map_rect, self.ticks, winner, len(self.players))
+
+        for x, y, direction, color in self.players:
+            out += PLAYER.pack(x, y, DIRECTIONS.index(direction), *color)
+
+        out += COUNT.pack(len(self.obstacles))
+        for rect in self.obstacles:
+            out += OBSTACLE.pack(*rect)
+
+        # turns are mostly a few ticks apart, so only the
+        # difference to the previous one is stored.
+        out += COUNT.pack(len(self.turns))
+        last_tick = 0
+        for tick, player, direction in self.turns:
+            write_varint(out, tick - last_tick)
+            write_varint(out, player * 4 + DIRECTIONS.index(direction))
+            last_tick = tick
+
+        return bytes(out)
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            f.write(self.to_bytes())
+
+    def build_map(self, players):
+        # the map as it was at the start of the round, with the
+        # given players put where the recorded ones started.
+        game_map = cycles.GameMap(*self.map_rect, self.seed)
+        for rect in self.obstacles:
+            game_map.add_obstacle(*rect)
+
+        for p, (x, y, direction, color) in zip(players, self.players):
+            p.trail.clear()
+            p.x = x
+            p.y = y
+            p.direction = direction
+            game_map.add_player(p)
+
+        game_map.enable_occupancy()
+        return game_map
+
+    def play(self, until_tick=None):
+        # play the round again up to until_tick, or to the end.
+        # returns the Simulation, its players are ReplayPlayers.
+        players = [ReplayPlayer(pygame.Color(*color)) for x, y, d, color in self.players]
+        for tick, player, direction in self.turns:
+            players[player].turns[tick] = direction
+
+        simulation = cycles.Simulation(players, self.tick_rate, self.shrink_seconds, self.shrink_size)
+        simulation.start_round(game_map=self.build_map(players))
+        for p in players:
+            p.simulation = simulation
+
+        if until_tick is None:
+            until_tick = self.ticks
+        while simulation.ticks < until_tick and not simulation.round_over:
+            simulation.step()
+
+        return simulation
+
+
+class ReplayPlayer(cycles.Player):
+    # follows recorded turns instead of taking any input
+    def __init__(self, color):
+        super().__init__(0, 0, color, None)
+
+        # tick -> direction of the new line started on that tick
+        self.turns = {}
+        # set by Replay.play, for the current tick
+        self.simulation = None
+
+    def handle_input(self):
+        direction = self.turns.get(self.simulation.ticks)
+        if direction is None:
+            return None
+
+        self.direction = direction
+        self.start_new_line()
+
+
+def record(simulation):
+    # make a Replay of the round a Simulation is playing or
+    # has played.
+    game_map = simulation.game_map
+
+    r = Replay()
+    r.seed = game_map.seed
+    r.tick_rate = simulation.tick_rate
+    r.shrink_seconds = simulation.shrink_seconds
+    r.shrink_size = simulation.shrink_size
+    r.map_rect = (game_map.orig_x, game_map.orig_y, game_map.orig_width, game_map.orig_height)
+
+    r.ticks = simulation.ticks
+    if simulation.winner is not None:
+        r.winner = simulation.players.index(simulation.winner)
+
+    for p, (x, y, direction) in zip(simulation.players, simulation.start_positions):
+        color = (p.color.r, p.color.g, p.color.b)
+        r.players.append((x, y, direction, color))
+    r.obstacles = [(o.x, o.y, o.w, o.h) for o in game_map.obstacles]
+    r.turns = list(simulation.turns)
+
+    return r
+
+
+def from_bytes(data):
+    # data can be anything that slices into bytes, like an mmap
+    magic, version, seed, tick_rate, shrink_seconds, shrink_size, \
+        x, y, w, h, ticks, winner, player_count = HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise Exception("not a cycles replay")
+    if version != VERSION:
+        raise Exception("unsupported replay version: {}".format(version))
+
+    r = Replay()
+    r.seed = seed
+    r.tick_rate = tick_rate
+    r.shrink_seconds = shrink_seconds
+    r.shrink_size = shrink_size
+    r.map_rect = (x, y, w, h)
+    r.ticks = ticks
+    if winner != NO_WINNER:
+        r.winner = winner
+
+    pos = HEADER.size
+    for i in range(player_count):
+        px, py, direction, cr, cg, cb = PLAYER.unpack_from(data, pos)
+        r.players.append((px, py, DIRECTIONS[direction], (cr, cg, cb)))
+        pos += PLAYER.size
+
+    count = COUNT.unpack_from(data, pos)[0]
+    pos += COUNT.size
+    for i in range(count):
+        r.obstacles.append(OBSTACLE.unpack_from(data, pos))
+        pos += OBSTACLE.size
+
+    count = COUNT.unpack_from(data, pos)[0]
+    pos += COUNT.size
+    tick = 0
+    for i in range(count):
+        delta, pos = read_varint(data, pos)
+        code, pos = read_varint(data, pos)
+        tick += delta
+        r.turns.append((tick, code // 4, DIRECTIONS[code % 4]))
+
+    return r
+
+
+def load(path):
+    with open(path, "rb") as f:
+        return from_bytes(f.read())
@@ -0,0 +1,206 @@
+"""
+Checks that the different ways of playing a round agree with each
+other, on a few fixed seeds.
+
+    python -m pytest tests.py
+
+The occupancy grid has to give the same rounds as the line geometry,
+restoring a snapshot has to go back to exactly the same state, and a
+VecEnv has to play the same rounds as Simulation. The VecEnv check
+needs numpy and is skipped without it.
+"""
+
+import os
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+import pytest
+
+import cycles
+
+
+def get_trails(simulation):
+    # every line of every player, as x1, y1, x2, y2
+    return [[p.trail.get_row(i) for i in range(len(p.trail))] for p in simulation.players]
+
+
+def get_state(simulation):
+    # what a restored snapshot has to get back exactly
+    game_map = simulation.game_map
+    state = [simulation.ticks, simulation.shrink_counter, simulation.round_over,
+             [simulation.players.index(p) for p in simulation.crashed_players],
+             list(simulation.turns), game_map.rng.getstate(),
+             (game_map.x, game_map.y, game_map.width, game_map.height),
+             {cell: list(bucket) for cell, bucket in game_map.segment_index.buckets.items()},
+             [game_map.obstacles.index(o) for o in game_map.obstacle_index.obstacles],
+             get_trails(simulation)]
+
+    grid = game_map.occupancy
+    if grid is not None:
+        state.append(bytes(grid.cells))
+        if grid.free_run is not None:
+            free_run = grid.free_run
+            state.extend(bytes(table) for table in (free_run.left, free_run.right, free_run.up, free_run.down))
+
+    for p in simulation.players:
+        state.append(p.save_state())
+
+    return state
+
+
+@pytest.mark.parametrize("game_mode, seed", [("pve", 1), ("1pffa", 2)])
+def test_grid_matches_lines(game_mode, seed):
+    # the AI probes lines either way, only the collision checks differ
+    rounds = []
+    for occupancy in [True, False]:
+        players = cycles.create_players(game_mode, human_seats=False)
+        for p in players:
+            p.use_free_run = False
+        simulation = cycles.Simulation(players, shrink_seconds=5, occupancy=occupancy, free_run=False)
+        winner = simulation.run_round(seed)
+        rounds.append((simulation.ticks, None if winner is None else players.index(winner),
+                       get_trails(simulation), simulation.turns))
+
+    assert rounds[0] == rounds[1]
+
+
+@pytest.mark.parametrize("occupancy, free_run", [(True, True), (False, False)])
+def test_snapshot_restore(occupancy, free_run):
+    players = cycles.create_players("1pffa", human_seats=False)
+    for p in players:
+        p.use_free_run = free_run
+    simulation = cycles.Simulation(players, shrink_seconds=2, occupancy=occupancy, free_run=free_run)
+    simulation.start_round(3)
+    for i in range(100):
+        simulation.step()
+
+    # past a shrink, so the map rect and the border go back too
+    snapshot = simulation.snapshot()
+    start = get_state(simulation)
+    states = []
+    for i in range(150):
+        if simulation.step():
+            break
+        states.append(get_state(simulation))
+
+    simulation.restore(snapshot)
+    assert get_state(simulation) == start
+
+    # and plays on the same from there
+    for state in states:
+        simulation.step()
+        assert get_state(simulation) == state
+
+
+def test_shrink_drops_obstacles():
+    players = cycles.create_players("1pffa", human_seats=False)
+    simulation = cycles.Simulation(players)
+    simulation.start_round(3)
+    game_map = simulation.game_map
+    snapshot = simulation.snapshot()
+    start = get_state(simulation)
+
+    game_map.shrink(300)
+    x1, y1 = game_map.x, game_map.y
+    x2, y2 = x1 + game_map.width, y1 + game_map.height
+    live = [o for o in game_map.obstacles if o.x <= x2 and o.x + o.w >= x1 and o.y <= y2 and o.y + o.h >= y1]
+    assert 0 < len(live) < len(game_map.obstacles)
+    assert game_map.obstacle_index.obstacles == live
+    everywhere = game_map.obstacle_index.overlapping(game_map.orig_x, game_map.orig_y,
+                                                     game_map.orig_x + game_map.orig_width,
+                                                     game_map.orig_y + game_map.orig_height)
+    assert len(everywhere) == len(live)
+    if cycles.numpy is not None:
+        assert game_map.get_obstacle_table().tolist() == [[o.x, o.y, o.w, o.h] for o in live]
+
+    simulation.restore(snapshot)
+    assert get_state(simulation) == start
+    if cycles.numpy is not None:
+        assert len(game_map.get_obstacle_table()) == len(game_map.obstacles)
+
+
+def test_vecenv_matches_simulation():
+    numpy = pytest.importorskip("numpy")
+    import vecenv
+
+    arenas = 6
+    seats = 3
+    env = vecenv.VecEnv(arenas, seats, (300, 200), shrink_seconds=2, levels=arenas, seed=4)
+    rng = numpy.random.default_rng(5)
+    actions = None
+
+    class ScriptedPlayer(cycles.Player):
+        # turns like the VecEnv actions say
+        def __init__(self, arena, seat):
+            super().__init__(0, 0, None, None)
+            self.arena = arena
+            self.seat = seat
+
+        def handle_input(self):
+            action = actions[self.arena, self.seat]
+            if action < 0:
+                return None
+            direction = vecenv.DIRECTIONS[action]
+            if direction == self.direction or cycles.is_opposing_direction(direction, self.direction):
+                return None
+            self.direction = direction
+            self.start_new_line()
+
+    simulations = []
+    for k in range(arenas):
+        players = [ScriptedPlayer(k, seat) for seat in range(seats)]
+        simulation = cycles.Simulation(players, shrink_seconds=2, free_run=False, map_size=(300, 200))
+        simulation.start_round(env.levels[env.level[k]].seed)
+        simulations.append(simulation)
+
+    # each arena until its first round is over
+    playing = set(range(arenas))
+    while playing:
+        actions = vecenv.random_actions(rng, arenas, seats, 0.05)
+        for k in playing:
+            simulations[k].step()
+        rewards, dones = env.step(actions)
+
+        for k in list(playing):
+            simulation = simulations[k]
+            game_map = simulation.game_map
+            if dones[k]:
+                winner = -1
+                if simulation.winner is not None:
+                    winner = simulation.players.index(simulation.winner)
+                assert simulation.round_over
+                assert env.winners[k] == winner
+                playing.remove(k)
+                continue
+
+            assert not simulation.round_over
+            for seat, p in enumerate(simulation.players):
+                alive = not p in simulation.crashed_players
+                assert env.alive[k, seat] == alive
+                if alive:
+                    assert env.x[k, seat] == p.x - game_map.orig_x
+                    assert env.y[k, seat] == p.y - game_map.orig_y
+
+            grid = game_map.occupancy
+            cells = numpy.frombuffer(grid.cells, dtype=numpy.uint8).reshape(grid.h, grid.w)
+            assert (env.cells[k, 1:-1, 1:-1] == cells).all()
+
+
+def test_arena_keeps_turning_players():
+    # a player that turned this tick is where its new line starts,
+    # it mustn't look crashed to the rollouts
+    players = cycles.create_players("1pffa", human_seats=False)
+    simulation = cycles.Simulation(players, shrink_seconds=5)
+    simulation.start_round(3)
+    while not simulation.crashed_players:
+        assert not simulation.step()
+
+    alive = simulation.game_map.alive_players()
+    p = alive[-1]
+    p.direction = {"up": "right", "right": "down", "down": "left", "left": "up"}[p.direction]
+    p.start_new_line()
+
+    arena = cycles.RolloutArena()
+    arena.load(simulation.game_map, me=players.index(alive[0]))
+    for i, q in enumerate(players):
+        assert arena.start_alive[i] == (q in alive)
+    assert arena.start_marked[players.index(p)]
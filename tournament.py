@@ -0,0 +1,260 @@
+"""
+Runs AI vs AI tournaments without a window, spread over all the
+cores of the machine.
+
+    python tournament.py round-robin ai ai-lines --mode 1pffa --rounds 50
+    python tournament.py gauntlet ai-lines ai --mode pve --rounds 100
+    python tournament.py gauntlet territory ai --mode 1pffa --rounds 20
+    python tournament.py gauntlet mcts ai --mode pve --rounds 20
+    python tournament.py round-robin ai ai-lines --players 32 --map-size 2000x2000
+
+In a round robin every pair of variants plays each other. In a
+gauntlet the first variant plays from every seat, with the other
+variants filling the rest of the seats. The human seats of a game
+mode are taken by AI players too.
+"""
+
+import os
+# keep every worker from printing the pygame banner
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import sys
+import time
+
+import cycles
+import replay
+
+
+# about what the MCTS AI gets through in its time budget on one core
+MCTS_ROLLOUTS = 50
+
+
+def make_ai(color):
+    return cycles.AIPlayer(0, 0, color, None)
+
+
+def make_line_ai(color):
+    # the older AI, that probes lines instead of
+    # reading the free run tables
+    p = cycles.AIPlayer(0, 0, color, None)
+    p.use_free_run = False
+    return p
+
+
+def make_territory_ai(color):
+    return cycles.TerritoryAIPlayer(0, 0, color, None)
+
+
+def make_mcts_ai(color):
+    # a fixed number of rollouts instead of the time budget, so the
+    # seed decides the match whatever the load on the machine
+    p = cycles.MCTSPlayer(0, 0, color, None)
+    p.max_rollouts = MCTS_ROLLOUTS
+    return p
+
+
+# variant name -> function that makes a player with the given color
+VARIANTS = {"ai": make_ai,
+            "ai-lines": make_line_ai,
+            "territory": make_territory_ai,
+            "mcts": make_mcts_ai}
+
+GAME_MODES = ["pve", "1pffa", "2pffa"]
+
+
+def get_seat_colors(game_mode, player_count=None):
+    # the seats and their colors, as play_game would have them
+    return [p.color for p in cycles.create_players(game_mode, human_seats=False, player_count=player_count)]
+
+
+def round_robin_lineups(variants, seats):
+    # each pair of variants takes alternating seats, once
+    # starting from either side.
+    lineups = []
+    for a, b in itertools.combinations(variants, 2):
+        lineups.append([(a, b)[i % 2] for i in range(seats)])
+        lineups.append([(b, a)[i % 2] for i in range(seats)])
+
+    return lineups
+
+
+def gauntlet_lineups(challenger, field, seats):
+    # the challenger goes through every seat, the field
+    # takes turns filling the others.
+    lineups = []
+    for seat in range(seats):
+        others = itertools.cycle(field)
+        lineup = [next(others) for i in range(seats)]
+        lineup[seat] = challenger
+        lineups.append(lineup)
+
+    return lineups
+
+
+def make_matches(lineups, game_mode, rounds, seed, replay_dir=None, level=None):
+    """
+    level -> keyword arguments for the Simulation, like map_size
+    """
+    # every lineup is played rounds times, each match
+    # gets its own seed.
+    if level is None:
+        level = {}
+
+    matches = []
+    for r in range(rounds):
+        for lineup in lineups:
+            match_id = len(matches)
+            matches.append((match_id, game_mode, lineup, seed + match_id, replay_dir, level))
+
+    return matches
+
+
+def play_match(match):
+    # runs in a worker process, returns a dict that can be
+    # sent back to the main process.
+    match_id, game_mode, lineup, seed, replay_dir, level = match
+
+    colors = get_seat_colors(game_mode, len(lineup))
+    players = [VARIANTS[name](color) for name, color in zip(lineup, colors)]
+
+    simulation = cycles.Simulation(players, **level)
+    winner = simulation.run_round(seed)
+
+    if replay_dir is not None:
+        path = os.path.join(replay_dir, "match-{:06d}.cyr".format(match_id))
+        replay.record(simulation).save(path)
+
+    # the winner survived the whole round
+    survival = []
+    for p in players:
+        ticks = simulation.crash_ticks.get(p, simulation.ticks)
+        survival.append(ticks / simulation.tick_rate)
+
+    winner_seat = None
+    if winner is not None:
+        winner_seat = players.index(winner)
+
+    return {"match": match_id,
+            "mode": game_mode,
+            "seed": seed,
+            "lineup": lineup,
+            "winner": winner_seat,
+            "ticks": simulation.ticks,
+            "survival": survival}
+
+
+class Standings():
+    def __init__(self):
+        # variant -> [seats played, wins, seconds survived]
+        self.table = {}
+        self.matches = 0
+
+    def add(self, result):
+        self.matches += 1
+        for seat, name in enumerate(result["lineup"]):
+            row = self.table.setdefault(name, [0, 0, 0.0])
+            row[0] += 1
+            row[2] += result["survival"][seat]
+            if result["winner"] == seat:
+                row[1] += 1
+
+    def report(self):
+        lines = ["{:<16}{:>8}{:>8}{:>8}{:>12}".format("variant", "seats", "wins", "win%", "survival")]
+        rows = sorted(self.table.items(), key=lambda item: item[1][1] / item[1][0], reverse=True)
+        for name, (seats, wins, seconds) in rows:
+            lines.append("{:<16}{:>8}{:>8}{:>8.1f}{:>11.1f}s".format(
+                name, seats, wins, 100 * wins / seats, seconds / seats))
+
+        return "\n".join(lines)
+
+
+def run_tournament(matches, processes=None, out_file=None, progress=True):
+    # results are streamed back as the workers finish them, in
+    # whatever order that happens.
+    standings = Standings()
+    start = time.time()
+
+    with multiprocessing.Pool(processes) as pool:
+        for result in pool.imap_unordered(play_match, matches):
+            standings.add(result)
+            if out_file is not None:
+                out_file.write(json.dumps(result) + "\n")
+
+            if progress:
+                rate = standings.matches / (time.time() - start)
+                print("\r{}/{} matches, {:.1f}/s".format(standings.matches, len(matches), rate),
+                      end="", file=sys.stderr, flush=True)
+
+    if progress:
+        print(file=sys.stderr)
+
+    return standings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run AI vs AI tournaments.")
+    parser.add_argument("format", choices=["round-robin", "gauntlet"])
+    parser.add_argument("variants", nargs="+", choices=sorted(VARIANTS),
+                        help="for a gauntlet, the challenger and then the field")
+    parser.add_argument("--mode", choices=GAME_MODES, default="1pffa")
+    parser.add_argument("--players", type=int, default=None,
+                        help="how many players in the ffa modes, 6 by default")
+    parser.add_argument("--map-size", default=None, metavar="WxH",
+                        help="size of the map, 800x500 by default")
+    parser.add_argument("--obstacle-density", type=float, default=cycles.OBSTACLE_DENSITY,
+                        help="obstacles per 100x100 pixels")
+    parser.add_argument("--rounds", type=int, default=10,
+                        help="how many times every lineup is played")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--processes", type=int, default=None,
+                        help="worker processes, all cores by default")
+    parser.add_argument("--out", default=None,
+                        help="write every match result to this file as json lines")
+    parser.add_argument("--replays", default=None, metavar="DIR",
+                        help="save a replay of every match in this directory")
+    args = parser.parse_args()
+
+    if args.players is not None and args.mode == "pve":
+        parser.error("pve is always two players")
+    seats = len(get_seat_colors(args.mode, args.players))
+
+    level = {"obstacle_density": args.obstacle_density}
+    if args.map_size is not None:
+        try:
+            w, h = args.map_size.lower().split("x")
+            level["map_size"] = (int(w), int(h))
+        except ValueError:
+            parser.error("map size should look like 2000x2000")
+    if args.format == "round-robin":
+        if len(args.variants) < 2:
+            parser.error("a round robin needs at least two variants")
+        lineups = round_robin_lineups(args.variants, seats)
+    else:
+        if len(args.variants) < 2:
+            parser.error("a gauntlet needs a challenger and a field")
+        lineups = gauntlet_lineups(args.variants[0], args.variants[1:], seats)
+
+    if args.replays is not None:
+        os.makedirs(args.replays, exist_ok=True)
+
+    matches = make_matches(lineups, args.mode, args.rounds, args.seed, args.replays, level)
+
+    out_file = None
+    if args.out is not None:
+        out_file = open(args.out, "w")
+
+    try:
+        standings = run_tournament(matches, args.processes, out_file)
+    finally:
+        if out_file is not None:
+            out_file.close()
+
+    print(standings.report())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,439 @@
+"""
+Many rounds at once, for training and tuning AI.
+
+A VecEnv keeps K arenas as one stack of occupancy grids, with the
+positions, directions and alive flags of every player in arrays. A
+step takes one direction per player per arena and moves all of them
+with a handful of numpy operations per seat, following the same rules
+as Player.update, GameMap.shrink and start_level. Arenas whose round
+is over start a new one on their own.
+
+    env = vecenv.VecEnv(256, players=6)
+    rewards, dones = env.step(actions)
+
+A SharedVecEnv splits the arenas over worker processes. All of its
+arrays are in shared memory, so a step only hands over the actions
+and waits for the workers, nothing is pickled.
+
+    with vecenv.SharedVecEnv(1024, workers=8, players=6) as env:
+        rewards, dones = env.step(actions)
+
+Needs numpy.
+
+    python vecenv.py --arenas 256 --players 6
+    python vecenv.py --arenas 1024 --players 6 --workers 8
+"""
+
+import os
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+import argparse
+import multiprocessing
+from multiprocessing import shared_memory
+import random
+import threading
+import time
+
+import numpy
+
+import cycles
+import replay
+
+
+# actions and directions are indexes in here, -1 means keep going
+DIRECTIONS = replay.DIRECTIONS
+OPPOSITE = numpy.array([1, 0, 3, 2], dtype=numpy.int8)
+DX = numpy.array([0, 0, -1, 1], dtype=numpy.int32)
+DY = numpy.array([-1, 1, 0, 0], dtype=numpy.int32)
+
+# what the workers of a SharedVecEnv do after the next barrier
+COMMAND_STEP = 0
+COMMAND_STOP = 1
+
+
+class Level():
+    # a round as start_level makes it, kept to start arenas from
+    def __init__(self, seed, players, map_size, obstacle_density):
+        seats = [cycles.Player(0, 0, None, None) for i in range(players)]
+        game_map = cycles.start_level(seats, True, False, seed, map_size, obstacle_density)
+        grid = game_map.occupancy
+
+        self.seed = seed
+        # the grid with a ring of border around it, see VecEnv
+        self.cells = numpy.full((grid.h + 2, grid.w + 2), cycles.CELL_BORDER, dtype=numpy.uint8)
+        self.cells[1:-1, 1:-1] = numpy.frombuffer(grid.cells, dtype=numpy.uint8).reshape(grid.h, grid.w)
+
+        self.x = numpy.array([p.x - grid.x for p in seats], dtype=numpy.int32)
+        self.y = numpy.array([p.y - grid.y for p in seats], dtype=numpy.int32)
+        self.direction = numpy.array([DIRECTIONS.index(p.direction) for p in seats], dtype=numpy.int8)
+
+
+def get_layout(arenas, players, map_size):
+    """
+    The arrays a VecEnv keeps its state and results in, with the arena
+    first, as (name, shape, dtype):
+
+    cells -> the occupancy grids with one more ring of border around
+    them. a cell is CELL_FREE, CELL_OBSTACLE, CELL_BORDER or 1 + the
+    seat that left a trail there.
+    x, y -> positions in grid coordinates, without the ring
+    direction -> indexes in DIRECTIONS
+    ticks -> ticks played in the current round
+    rect -> the map rect x, y, w, h in grid coordinates
+    level -> the level each arena is playing, an index in VecEnv.levels
+    rewards, dones, winners -> what the last step returned, winners is
+    the seat of the winner of rounds that just ended, -1 if none
+    """
+    w, h = map_size
+    return [("cells", (arenas, h + 3, w + 3), numpy.uint8),
+            ("x", (arenas, players), numpy.int32),
+            ("y", (arenas, players), numpy.int32),
+            ("direction", (arenas, players), numpy.int8),
+            ("alive", (arenas, players), numpy.bool_),
+            ("ticks", (arenas,), numpy.int32),
+            ("rect", (arenas, 4), numpy.int32),
+            ("level", (arenas,), numpy.int32),
+            ("rewards", (arenas, players), numpy.float32),
+            ("dones", (arenas,), numpy.bool_),
+            ("winners", (arenas,), numpy.int32)]
+
+
+class VecEnv():
+    # all the state is in the arrays of get_layout, so it can be read
+    # as observations without copying
+    def __init__(self, arenas, players=2, map_size=cycles.MAP_SIZE, obstacle_density=cycles.OBSTACLE_DENSITY,
+                 tick_rate=60, shrink_seconds=20, shrink_size=20, levels=32, seed=0, arrays=None):
+        """
+        levels -> how many different rounds start_level makes up front.
+        an arena that starts a new round copies a random one of them,
+        since making a level is far slower than playing a tick.
+        arrays -> name -> array for the arrays of get_layout to use
+        instead of new ones, like views of shared memory
+        """
+        if players < 1 or players >= cycles.CELL_OBSTACLE:
+            raise Exception("unsupported number of players")
+
+        self.arenas = arenas
+        self.players = players
+        self.map_size = map_size
+        self.shrink_rate = tick_rate * shrink_seconds
+        self.shrink_size = shrink_size
+
+        rng = random.Random(seed)
+        self.levels = [Level(rng.getrandbits(32), players, map_size, obstacle_density) for i in range(levels)]
+        self.rng = numpy.random.default_rng(seed)
+
+        if arrays is None:
+            arrays = {}
+        for name, shape, dtype in get_layout(arenas, players, map_size):
+            array = arrays.get(name)
+            if array is None:
+                array = numpy.zeros(shape, dtype=dtype)
+            elif array.shape != shape or array.dtype != dtype or not array.flags.c_contiguous:
+                raise Exception("wrong shape or type for the {} array".format(name))
+            setattr(self, name, array)
+
+        # the grids seen as one long row of cells, and where each
+        # arena starts in it
+        rows, cols = self.cells.shape[1:]
+        self.flat = self.cells.reshape(-1)
+        self.stride = cols
+        self.base = numpy.arange(arenas, dtype=numpy.int64)[:, None] * (rows * cols)
+
+        # seats that took their cell when they turned, see step
+        self.head_marked = numpy.zeros((arenas, players), dtype=numpy.bool_)
+
+        self.winners[:] = -1
+        self.reset(numpy.arange(arenas))
+
+    def reset(self, arenas):
+        # start new rounds on the given arenas
+        w, h = self.map_size
+        for k in arenas:
+            n = self.rng.integers(len(self.levels))
+            level = self.levels[n]
+            self.level[k] = n
+            self.cells[k] = level.cells
+            self.x[k] = level.x
+            self.y[k] = level.y
+            self.direction[k] = level.direction
+            self.alive[k] = True
+            self.ticks[k] = 0
+            self.rect[k] = (0, 0, w, h)
+
+    def shrink(self, arenas):
+        # like GameMap.shrink, everything outside the new rect
+        # (and its far edges) becomes border
+        n = self.shrink_size
+        for k in arenas:
+            x, y, w, h = self.rect[k]
+            x, y, w, h = x + n // 2, y + n // 2, w - n, h - n
+            self.rect[k] = (x, y, w, h)
+
+            grid = self.cells[k]
+            border = cycles.CELL_BORDER
+            if w < 0 or h < 0:
+                grid[:] = border
+                continue
+            grid[:y+1] = border
+            grid[y+h+2:] = border
+            grid[:, :x+1] = border
+            grid[:, x+w+2:] = border
+
+    def step(self, actions):
+        """
+        actions -> int (K, P), the direction each player turns to, or
+        -1 to keep going. turning back or to the same direction does
+        nothing, like Player.handle_input.
+        """
+        # play one tick in every arena. returns (rewards, dones), the
+        # winner of a round gets a reward of 1. arenas that are done
+        # have started their next round already, winners says who won.
+        flat = self.flat
+        alive = self.alive
+        direction = self.direction
+        actions = numpy.asarray(actions)
+
+        # the countdown of Simulation.step
+        shrinking = numpy.flatnonzero((self.ticks > 0) & (self.ticks % self.shrink_rate == 0))
+        if len(shrinking) > 0:
+            self.shrink(shrinking)
+
+        # where every player is in self.flat, nobody moves until
+        # the end of the tick
+        cell = self.base + (self.y + 1) * self.stride + self.x + 1
+
+        # everyone turns before anyone moves. a new line takes the
+        # cell it starts on right away, see Player.start_new_line.
+        # the cells are taken in seat order, in case two players
+        # turn on the same one.
+        turn = alive & (actions >= 0) & (actions != direction) & (actions != OPPOSITE[direction])
+        head_marked = self.head_marked
+        head_marked[:] = False
+        if turn.any():
+            direction[turn] = actions[turn]
+            for seat in numpy.flatnonzero(turn.any(axis=0)):
+                i = cell[turn[:, seat], seat]
+                free = flat[i] == cycles.CELL_FREE
+                flat[i[free]] = seat + 1
+                head_marked[turn[:, seat], seat] = free
+
+        # then they move in seat order, so a cell goes to the first
+        # one to get there. outside of the map rect everything is
+        # border, so that is a crash as well.
+        claimed = numpy.zeros_like(alive)
+        for seat in range(self.players):
+            i = cell[:, seat]
+            claim = alive[:, seat] & (flat[i] == cycles.CELL_FREE)
+            flat[i[claim]] = seat + 1
+            claimed[:, seat] = claim
+
+        alive &= claimed | head_marked
+        self.x += DX[direction] * alive
+        self.y += DY[direction] * alive
+
+        self.ticks += 1
+
+        # the last one standing wins, nobody does if everyone left
+        # crashed on the same tick
+        left = alive.sum(axis=1)
+        dones = left <= 1
+        winners = numpy.where(left == 1, alive.argmax(axis=1), -1)
+
+        self.rewards[:] = 0
+        won = numpy.flatnonzero(winners >= 0)
+        self.rewards[won, winners[won]] = 1
+        self.dones[:] = dones
+        self.winners[:] = winners
+
+        over = numpy.flatnonzero(dones)
+        if len(over) > 0:
+            self.reset(over)
+
+        return self.rewards, self.dones
+
+
+def run_worker(specs, start, end, players, seed, kwargs, barrier):
+    # plays arenas start to end of a SharedVecEnv, in its own process.
+    # a step starts and ends on the barrier.
+    blocks = []
+    arrays = {}
+    for name, memory_name, shape, dtype in specs:
+        block = shared_memory.SharedMemory(name=memory_name)
+        blocks.append(block)
+        arrays[name] = numpy.ndarray(shape, dtype, buffer=block.buf)
+
+    try:
+        command = arrays.pop("command")
+        arrays = {name: array[start:end] for name, array in arrays.items()}
+        actions = arrays["actions"]
+        env = VecEnv(end - start, players, seed=seed, arrays=arrays, **kwargs)
+        barrier.wait()
+
+        while True:
+            barrier.wait()
+            if command[0] == COMMAND_STOP:
+                break
+            env.step(actions)
+            barrier.wait()
+    except BaseException:
+        # don't leave the others waiting for us
+        barrier.abort()
+        raise
+    finally:
+        # the views have to go before the memory can be closed
+        env = arrays = actions = command = None
+        for block in blocks:
+            block.close()
+
+
+class SharedVecEnv():
+    """
+    The arenas of a VecEnv, split over worker processes that each
+    play their own part of them. The arrays of get_layout and the
+    actions are in shared memory and can be read between steps
+    without copying, like the ones of a VecEnv.
+    """
+    def __init__(self, arenas, workers=None, players=2, map_size=cycles.MAP_SIZE, seed=0, **kwargs):
+        """
+        workers -> how many processes, one per core by default
+        kwargs -> the other arguments of VecEnv
+        """
+        if workers is None:
+            workers = os.cpu_count()
+        workers = max(min(workers, arenas), 1)
+
+        self.arenas = arenas
+        self.players = players
+        self.workers = workers
+
+        layout = get_layout(arenas, players, map_size)
+        layout.append(("actions", (arenas, players), numpy.int8))
+        layout.append(("command", (1,), numpy.int8))
+
+        self.blocks = []
+        specs = []
+        for name, shape, dtype in layout:
+            dtype = numpy.dtype(dtype)
+            size = max(int(numpy.prod(shape)) * dtype.itemsize, 1)
+            block = shared_memory.SharedMemory(create=True, size=size)
+            self.blocks.append(block)
+            setattr(self, name, numpy.ndarray(shape, dtype, buffer=block.buf))
+            specs.append((name, block.name, shape, dtype.str))
+        self.command[0] = COMMAND_STEP
+
+        # the workers and this process meet on it before and after
+        # every step
+        self.barrier = multiprocessing.Barrier(workers + 1)
+
+        kwargs["map_size"] = map_size
+        self.processes = []
+        for i in range(workers):
+            start = arenas * i // workers
+            end = arenas * (i + 1) // workers
+            p = multiprocessing.Process(target=run_worker, daemon=True,
+                                        args=(specs, start, end, players, seed + i, kwargs, self.barrier))
+            p.start()
+            self.processes.append(p)
+
+        # wait until they all have their levels made
+        self.wait()
+
+    def wait(self):
+        try:
+            self.barrier.wait()
+        except threading.BrokenBarrierError:
+            self.close()
+            raise Exception("a worker process failed")
+
+    def step(self, actions):
+        # like VecEnv.step. the returned arrays are the shared ones,
+        # they change with the next step.
+        self.actions[:] = actions
+        self.wait()
+        self.wait()
+        return self.rewards, self.dones
+
+    def close(self):
+        if len(self.processes) == 0:
+            return
+
+        if not self.barrier.broken:
+            self.command[0] = COMMAND_STOP
+            try:
+                self.barrier.wait()
+            except threading.BrokenBarrierError:
+                pass
+        for p in self.processes:
+            p.join()
+        self.processes = []
+
+        for name, shape, dtype in get_layout(self.arenas, self.players, (0, 0)):
+            setattr(self, name, None)
+        self.actions = self.command = None
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def random_actions(rng, arenas, players, turn_chance):
+    # each player turns to a random direction now and then
+    actions = rng.integers(0, 4, size=(arenas, players), dtype=numpy.int8)
+    actions[rng.random((arenas, players)) >= turn_chance] = -1
+    return actions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure how fast a VecEnv plays with random players.")
+    parser.add_argument("--arenas", type=int, default=256)
+    parser.add_argument("--players", type=int, default=6)
+    parser.add_argument("--map-size", default="800x500", metavar="WxH")
+    parser.add_argument("--ticks", type=int, default=2000)
+    parser.add_argument("--turn-chance", type=float, default=0.02,
+                        help="how likely a player is to turn on a tick")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=None,
+                        help="play the arenas in this many processes with a SharedVecEnv")
+    args = parser.parse_args()
+
+    try:
+        w, h = args.map_size.lower().split("x")
+        map_size = (int(w), int(h))
+    except ValueError:
+        parser.error("map size should look like 800x500")
+
+    if args.workers is None:
+        env = VecEnv(args.arenas, args.players, map_size, seed=args.seed)
+    else:
+        env = SharedVecEnv(args.arenas, args.workers, args.players, map_size, seed=args.seed)
+    rng = numpy.random.default_rng(args.seed)
+
+    # the actions are made up front, so only the env is timed
+    actions = [random_actions(rng, args.arenas, args.players, args.turn_chance) for i in range(64)]
+
+    # only the players that are still alive count
+    player_ticks = 0
+    rounds = 0
+    start = time.perf_counter()
+    for t in range(args.ticks):
+        player_ticks += int(env.alive.sum())
+        rewards, dones = env.step(actions[t % len(actions)])
+        rounds += int(dones.sum())
+    elapsed = time.perf_counter() - start
+
+    if args.workers is not None:
+        env.close()
+
+    print("{} arenas, {} players: {:.2f}M player-ticks/s, {:.0f} ticks/s, {} rounds finished".format(
+        args.arenas, args.players, player_ticks / elapsed / 1e6, args.ticks / elapsed, rounds))
+
+
+if __name__ == "__main__":
+    main()